@@ -0,0 +1,216 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+
+import numpy as np
+
+from priceseries import from_ordinal, to_ordinal
+from rolling import asof_values
+
+
+def py_round(values, ndigits):
+    """ 逐个用内置 round 取整。np.round 先放大再取整，在 .5 附近与逐日计算的结果会有差异。 """
+    return np.array([round(v, ndigits) for v in values.tolist()], dtype=np.float64)
+
+
+def window_count(values, lo, hi, x, op, chunk=256):
+    """ 对每个 k 统计 values[lo[k]:hi[k]] 中满足 op(v, x[k]) 的个数。
+        按 chunk 行分块展开为二维数组比较，内存与 chunk * 最大窗口长度成正比。
+    """
+    counts = np.zeros(len(x), dtype=np.int64)
+    if len(x) == 0 or len(values) == 0:
+        return counts
+    offsets = np.arange(max(int((hi - lo).max()), 0))
+    for s in range(0, len(x), chunk):
+        idx = lo[s:s + chunk, None] + offsets
+        mask = idx < hi[s:s + chunk, None]
+        v = values[np.minimum(idx, len(values) - 1)]
+        counts[s:s + chunk] = (op(v, x[s:s + chunk, None]) & mask).sum(axis=1)
+    return counts
+
+
+def accumulate(capital, amount, price):
+    """ 由每天的申购金额、份额和累计净值计算累计投入、持有份额、市值、盈利百分比和平均成本。
+        盈利百分比与 Policy.buy_longtime 一致，保留两位小数，未投入时为 0。
+        参数也可以是 天数 × 基金数 的矩阵，按列分别累计。
+    """
+    cum_capital = np.cumsum(capital, axis=0)
+    cum_amount = np.cumsum(amount, axis=0)
+    invested = cum_capital > 0
+    gain = np.zeros(np.shape(capital))
+    gain[invested] = py_round(
+        (price[invested] * cum_amount[invested] - cum_capital[invested]) / cum_capital[invested] * 100, 2)
+    avg_cost = np.zeros(np.shape(capital))
+    held = cum_amount != 0
+    avg_cost[held] = cum_capital[held] / cum_amount[held]
+    return {
+        'capital': cum_capital,
+        'amount': cum_amount,
+        'value': cum_amount * price,
+        'gain': gain,
+        'avg_cost': avg_cost,
+    }
+
+
+def summarize(days, curve, price, begin_date):
+    """ 汇总为 buy_longtime 的返回值：(累计投入, 持有份额, [最高盈利, 日期], 盈利, 平均成本)，
+        盈利以最后一天的累计净值计算。
+    """
+    maxg = [0, begin_date]
+    if len(days) == 0:
+        return (0, 0, maxg, '0%', 0)
+    gain = curve['gain']
+    k = int(np.argmax(gain))
+    if gain[k] > 0:
+        maxg = [float(gain[k]), from_ordinal(days[k]).strftime('%Y-%m-%d')]
+    # 每天的申购金额都是整数
+    (b_capital, b_amount) = (int(curve['capital'][-1]), float(curve['amount'][-1]))
+    if b_capital == 0:
+        win = 0
+    else:
+        win = (b_amount * float(price[-1]) - b_capital) * 100 / b_capital
+    win = str(round(win, 2)) + '%'
+    avg_price = 0 if b_amount == 0 else (b_capital / b_amount)
+    return (round(b_capital, 2), round(b_amount, 2), maxg, win, round(avg_price, 4))
+
+
+class Backtest():
+    """ Policy 购买策略的向量化回测。
+
+        先按交易日一次算出净值、均值、排位、pe 水位线、回撤水位线等特征数组，
+        再按 buy_1day1 ~ buy_1day4 的规则整体计算每天的申购金额和份额，结果与逐日调用一致。
+
+    Attributes:
+        policy: 已加载净值、回撤和 pe/pb 的 Policy
+        avgdays: 均值和排位的天数
+        n: 幂，{'price': n, 'pe': n}
+        base: 每天的基础申购金额
+    """
+
+    def __init__(self, policy, avgdays, n, base=100):
+        self.policy = policy
+        self.avgdays = avgdays
+        self.n = n
+        self.base = base
+
+    def trade_days(self, begin_date, end_date):
+        return self.policy.trade_days.between(begin_date, end_date)
+
+    def features(self, days, buyfunc):
+        """ 计算 buyfunc 用到的特征，days 为交易日天序号数组 """
+        p = self.policy
+        res = {'days': days, 'price': p.price_list.ljjz[p.price_list.find_all(days)]}
+        if buyfunc in ('buy_1day1', 'buy_1day3'):
+            avg = p.load_avg_price(50, self.avgdays)
+            res['avg_price'] = avg.ljjz[days - avg.days[0]]
+        if buyfunc == 'buy_1day2':
+            lo = np.searchsorted(p.price_list.days, days - self.avgdays + 1)
+            hi = np.searchsorted(p.price_list.days, days)
+            # 与 fetch_price_info 的 higher 一致：窗口内严格大于当前净值的个数
+            res['rank'] = window_count(p.price_list.ljjz, lo, hi, res['price'], np.greater)
+            res['rank_length'] = hi - lo + 1
+        if buyfunc == 'buy_1day3':
+            res['pe30'] = self.pe_water(days, 30)
+            res['pe'] = self.pe(days)
+        if buyfunc == 'buy_1day4':
+            (res['revert'], res['revert_water']) = self.revert_water(days)
+        return res
+
+    def pe_water(self, days, n, day=365*5):
+        dj = self.policy.dj
+        nwater = dj.load_pbe_nwater(dj.water_lines if n in dj.water_lines else (n,), day)[(n, day)]
+        i = days - nwater.days[0]
+        valid = (i >= 0) & (i < len(nwater))
+        values = np.full(len(days), np.nan)
+        values[valid] = nwater.values[i[valid]]
+        # 超出预先计算范围的日期单独计算
+        for k in np.flatnonzero(np.isnan(values)).tolist():
+            values[k] = dj.get_pbe_nwater(from_ordinal(days[k]), n, day)
+        return values
+
+    def pe(self, days):
+        """ 当天的 pe，没有则向前最多找 30 天 """
+        pbe = self.policy.index_pbe
+        pe = np.full(len(days), -1.0)
+        done = np.zeros(len(days), dtype=bool)
+        for i in range(30):
+            v = asof_values(pbe, days - i)
+            pe = np.where(done, pe, v)
+            done |= v > 0
+        return pe
+
+    def revert_water(self, days, window=360*6):
+        """ 当天回撤及其在之前 window-1 天正回撤中的水位线，读取预先计算的序列 """
+        p = self.policy
+        idx = p.revert_list.find_all(days)
+        revert = np.where(idx >= 0, p.revert_list.values[idx], 0.0)
+        (water, _, _) = p.load_revert_water(window)
+        values = np.zeros(len(days))
+        i = days - water.days[0] if len(water) > 0 else np.full(len(days), -1)
+        valid = (i >= 0) & (i < len(water))
+        values[valid] = water.values[i[valid]]
+        # 超出预先计算范围的日期单独计算
+        for k in np.flatnonzero(~valid).tolist():
+            values[k] = p.get_revert_water(days[k], revert[k], window)[0]
+        return (revert, values)
+
+    def weights(self, buyfunc, feats):
+        """ 按 buyfunc 的规则计算每天的申购倍数，申购金额为 base 乘以倍数向上取整，不申购的日期为 0 """
+        price = feats['price']
+        weight = np.zeros(len(price))
+        buy = price > 0
+        if buyfunc == 'buy_1day1':
+            buy &= price <= feats['avg_price']
+            weight[buy] = (feats['avg_price'][buy] / price[buy]) ** self.n['price']
+        elif buyfunc == 'buy_1day2':
+            weight = (feats['rank'] + 1) * 1.0 / feats['rank_length'] / 0.5
+            weight[weight < 1] = 0
+            weight = weight ** 2
+        elif buyfunc == 'buy_1day3':
+            (pe, pe30, avg) = (feats['pe'], feats['pe30'], feats['avg_price'])
+            buy_pe = (pe <= pe30) & (pe > 0)
+            buy &= buy_pe & (price <= avg)
+            weight[buy] = (pe30[buy] / pe[buy]) ** self.n['pe'] * (avg[buy] / price[buy]) ** self.n['price']
+        elif buyfunc == 'buy_1day4':
+            water = feats['revert_water']
+            buy &= (feats['revert'] != 0) & ((water * 100).astype(int) >= 50)
+            weight[buy] = (water[buy] + 1) ** 6 / 10
+        else:
+            raise ValueError('unknown buyfunc {}'.format(buyfunc))
+        weight[~buy] = 0
+        return weight
+
+    def signals(self, buyfunc, feats):
+        """ 按 buyfunc 的规则计算每天的 (申购金额, 申购份额) """
+        price = feats['price']
+        weight = self.weights(buyfunc, feats)
+        buy = weight > 0
+        capital = np.zeros(len(price))
+        amount = np.zeros(len(price))
+        capital[buy] = np.ceil(self.base * weight[buy])
+        amount[buy] = py_round(capital[buy] / price[buy], 2)
+        return (capital, amount)
+
+    def run(self, buyfunc, begin_date, end_date):
+        """ 回测 [begin_date, end_date] 内每个交易日按 buyfunc 申购，返回每天的数组和汇总结果 """
+        days = self.trade_days(begin_date, end_date)
+        feats = self.features(days, buyfunc)
+        (capital, amount) = self.signals(buyfunc, feats)
+        curve = accumulate(capital, amount, feats['price'])
+        curve.update({'days': days, 'buy_capital': capital, 'buy_amount': amount})
+        curve['summary'] = summarize(days, curve, feats['price'], begin_date)
+        return curve
+
+
+if __name__ == '__main__':
+    from policy import Policy
+
+    p = Policy('100038')
+    p.load_fundprice()
+    p.load_revert()
+    p.init_index_pbe()
+    params = p.index['params']
+    end_date = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
+    begin_date = end_date - datetime.timedelta(days=365*6)
+    bt = Backtest(p, params['avgdays'], params['n'])
+    print(bt.run(params['buyfunc'], to_ordinal(begin_date), to_ordinal(end_date))['summary'])
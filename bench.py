@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" 热点函数的基准测试，不联网。
+
+    数据为仓库自带的 record.njbcz/record.wwxf/record.njbqg 和随机生成的 20 年净值、pe 序列，
+    在临时目录中运行，不读写当前目录的购买日志和回撤文件。
+    每个用例报告第一次调用（含预先计算）和之后的耗时、内存分配峰值和吞吐量（天/秒）。
+
+    python bench.py                         # 运行全部用例
+    python bench.py -k avg                  # 只运行名称包含 avg 的用例
+    python bench.py --save bench.json       # 保存结果作为基线
+    python bench.py --compare bench.json    # 与基线比较，变慢超过阈值的用例标记为 SLOWER
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from danjuan import Danjuan
+from policy import Policy
+from priceseries import PriceSeries, ValueSeries, from_ordinal, to_ordinal
+from rolling import rolling_revert
+from store import read_csv
+from tradecal import TradeCalendar
+
+record_funds = ('njbcz', 'wwxf', 'njbqg')
+# 逐日调用的函数测试最近两年的交易日
+sample_days = 365 * 2
+
+
+def record_policy(fid, root='.'):
+    """ 由仓库中的 csv 净值记录构造 Policy，回撤直接计算，不请求净值 """
+    p = Policy(fid)
+    (days, (nav, ljjz)) = read_csv(os.path.join(root, 'record.' + fid), 2)
+    p.price_list = PriceSeries(days, nav, ljjz)
+    p.loaded_date = p.price_list.last_date()
+    p.revert_list = rolling_revert(p.price_list, p.price_list.first_date(), p.price_list.last_date())
+    p.trade_days = TradeCalendar(days)
+    return p
+
+
+def synthetic_policy(fid='100038', years=20, seed=1):
+    """ 随机生成 years 年工作日的净值和 pe，构造跟踪指数的 Policy """
+    p = Policy(fid)
+    end = datetime.date.today().toordinal() - 1
+    cal = np.arange(end - 365 * years, end + 1, dtype=np.int32)
+    # 0001-01-01 为周一
+    days = cal[(cal - 1) % 7 < 5]
+    rng = np.random.RandomState(seed)
+    ljjz = np.round(np.exp(np.cumsum(rng.normal(0.0002, 0.012, len(days)))), 4)
+    pe = np.round(12 * np.exp(np.cumsum(rng.normal(0, 0.01, len(days)))), 2)
+    p.price_list = PriceSeries(days, ljjz, ljjz)
+    p.loaded_date = p.price_list.last_date()
+    p.revert_list = rolling_revert(p.price_list, p.price_list.first_date(), p.price_list.last_date())
+    p.dj = Danjuan(p.index['code'], p.index['vq'])
+    p.dj.pbe = ValueSeries(days, pe)
+    p.dj.loaded_date = datetime.date.today()
+    p.index_pbe = p.dj.pbe
+    p.trade_days = TradeCalendar(days)
+    return p
+
+
+def cases(name, p):
+    """ 返回 [(用例名, 准备函数, 测试函数, 处理的天数)]，同一基金的用例按顺序运行 """
+    params = p.index['params']
+    (buyfunc, avgdays, n) = (params['buyfunc'], params['avgdays'], params['n'])
+    last = p.price_list.last_date()
+    dts = [from_ordinal(o) for o in p.trade_days.between(to_ordinal(last) - sample_days + 1, last)]
+    end_date = last
+    begin_date = max(end_date - datetime.timedelta(days=365 * 6), p.price_list.first_date())
+    log_days = (end_date - begin_date).days + 1
+
+    def no_setup():
+        pass
+
+    def remove_buylog():
+        for path in (p.buylog_path + '.bin', p.buylog_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    res = [
+        ('get_revert', no_setup, lambda: [p.get_revert(dt) for dt in dts], len(dts)),
+        ('get_avg_price', no_setup, lambda: [p.get_avg_price(dt, 50, avgdays) for dt in dts], len(dts)),
+    ]
+    if p.index['code'] != '':
+        res.append(('get_pbe_nwater', no_setup, lambda: [p.dj.get_pbe_nwater(dt, 30) for dt in dts], len(dts)))
+    res += [
+        ('fetch_price_info', no_setup, lambda: [p.fetch_price_info(dt, avgdays) for dt in dts], len(dts)),
+        ('load_buylog', remove_buylog,
+            lambda: p.load_buylog(buyfunc, avgdays, begin_date, end_date, n), log_days),
+        ('buy_longtime', no_setup,
+            lambda: p.buy_longtime(buyfunc, avgdays, begin_date, end_date, n), log_days),
+    ]
+    return [('{}/{}'.format(name, case), setup, func, days) for (case, setup, func, days) in res]
+
+
+def measure(setup, func, days, repeat=5):
+    """ 第一次调用包含缓存的预先计算，单独记录；内存分配在之后单独用 tracemalloc 统计一次。
+        被测函数打印的提示信息不输出。
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat + 1):
+            setup()
+            t = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t)
+        setup()
+        tracemalloc.start()
+        func()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    best = min(times[1:])
+    return {
+        'days': days,
+        'first_ms': round(times[0] * 1000, 3),
+        'best_ms': round(best * 1000, 3),
+        'median_ms': round(float(np.median(times[1:])) * 1000, 3),
+        'days_per_sec': round(days / best) if best > 0 else 0,
+        'peak_kb': round(peak / 1024, 1),
+        'retained_kb': round(current / 1024, 1),
+    }
+
+
+def version():
+    try:
+        out = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL)
+        return out.decode('utf-8').strip()
+    except Exception:
+        return ''
+
+
+def run(pattern='', repeat=5):
+    """ 在临时目录中运行所有名称包含 pattern 的用例，返回结果字典 """
+    root = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix='fundbench')
+    results = {}
+    try:
+        os.chdir(tmp)
+        datasets = [(fid, lambda fid=fid: record_policy(fid, root)) for fid in record_funds]
+        datasets.append(('synthetic20y', synthetic_policy))
+        for (name, load) in datasets:
+            for (key, setup, func, days) in cases(name, load()):
+                if pattern in key:
+                    results[key] = measure(setup, func, days, repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        'version': version(),
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+
+
+def report(res, baseline=None, threshold=1.2):
+    """ 打印结果，有基线时按 best_ms 比较 """
+    print('version {} python {} numpy {}'.format(res['version'], res['python'], res['numpy']))
+    if baseline is not None:
+        print('baseline {} {}'.format(baseline['version'], baseline['time']))
+    head = '{:<32} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'
+    print(head.format('case', 'days', 'first_ms', 'best_ms', 'median_ms', 'days/s', 'peak_kb'))
+    slower = 0
+    for (key, r) in res['results'].items():
+        line = '{:<32} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            key, r['days'], r['first_ms'], r['best_ms'], r['median_ms'], r['days_per_sec'], r['peak_kb'])
+        if baseline is not None and key in baseline['results']:
+            base_ms = baseline['results'][key]['best_ms']
+            ratio = r['best_ms'] / base_ms if base_ms > 0 else 1
+            line += ' {:>6.2f}x'.format(ratio)
+            if ratio > threshold:
+                line += ' SLOWER'
+                slower += 1
+        print(line)
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fundvalue benchmarks')
+    parser.add_argument('-k', dest='pattern', default='', help='只运行名称包含该字符串的用例')
+    parser.add_argument('-n', dest='repeat', type=int, default=5, help='每个用例重复的次数')
+    parser.add_argument('--save', help='保存结果为基线 json')
+    parser.add_argument('--compare', help='与基线 json 比较')
+    parser.add_argument('--threshold', type=float, default=1.2, help='耗时超过基线的倍数视为变慢')
+    args = parser.parse_args()
+
+    res = run(args.pattern, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as fr:
+            baseline = json.load(fr)
+    slower = report(res, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as fw:
+            json.dump(res, fw, indent=2)
+    if slower > 0:
+        raise SystemExit(1)
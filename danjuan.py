@@ -1,8 +1,16 @@
 # -*- coding:utf-8 -*-
 
-import requests
 import datetime
 import json
+import math
+import os
+import threading
+
+import httpclient
+import metrics
+from priceseries import ValueSeries, to_ordinal
+from rolling import asof_values, rolling_quantiles
+from store import DayStore
 
 
 class Danjuan():
@@ -11,41 +19,136 @@ class Danjuan():
     Attributes:
         index_code: 指数编码
         index_vq: 指数估值依据，index_vq 为 pb 或者 pe
-        pbe: 字典，保存指数的历史pe/pb，{datetime: pe}
+        pbe: ValueSeries，保存指数交易日的历史pe/pb，非交易日用 get_pbe 按前一个交易日取值
+        nwater: 预先计算的水位线，{(n, day): ValueSeries}
+        pbe_path: 本地保存的 pe/pb 记录，见 DayStore，meta_path 保存上次请求的日期和缓存校验头
     """
 
+    # 接口地址，测试时可以替换为本地服务
+    eva_url = 'https://danjuanapp.com/djapi/index_eva/{}_history/{}?day={}'
+    # 预先计算的水位线
+    water_lines = (30, 50, 70, 90)
+    # 本地记录最后一天距今不超过该天数时只补充最近一年
+    topup_days = 300
+
     def __init__(self, index_code, index_vq):
         """ 初始化数据结构 """
         self.index_code = index_code
         self.index_vq = index_vq
-        self.pbe = {}
+        self.pbe = ValueSeries()
+        self.nwater = {}
+        self.loaded_date = None
+        self.lock = threading.RLock()
+        self.pbe_path = './pbe.{}.{}'.format(index_code, index_vq)
+        self.meta_path = self.pbe_path + '.json'
 
     def init_pbe(self, time='all'):
-        """ 获取pe/pb的通用接口，time可以为1y, 3y """
+        """ 获取pe/pb的通用接口，time可以为1y, 3y。同一天只加载一次。 """
+        with self.lock:
+            today = datetime.date.today()
+            if self.loaded_date != today:
+                with metrics.stage('load', self.index_code):
+                    self.pbe = self.update_pbe(time)
+                self.nwater = {}
+                self.loaded_date = today
+            return self.pbe
+
+    def update_pbe(self, time='all'):
+        """ 读取本地的 pe/pb 记录，不够新则从网上补齐并保存，返回交易日的 pe/pb。
+
+            本地已有昨天的数据，或今天已经请求过时不再请求；本地记录较新时只请求最近一年，否则请求 time。
+            服务器返回过 ETag/Last-Modified 时带上条件请求头，304 时沿用本地记录。
+        """
+        store = DayStore(self.pbe_path, 1)
+        try:
+            (days, (values,)) = store.load()
+            saved = ValueSeries(days, values)
+        except Exception:
+            saved = ValueSeries()
+        meta = self.load_meta()
+        today = datetime.date.today().toordinal()
+        if len(saved) > 0 and (saved.days[-1] >= today - 1 or meta.get('checked') == today):
+            return saved
+        if len(saved) > 0 and saved.days[-1] >= today - self.topup_days and meta.get('time', time) == time:
+            period = '1y'
+        else:
+            period = time
+        url = self.eva_url.format(self.index_vq, self.index_code, period)
+        headers = {}
+        if len(saved) > 0 and meta.get('url') == url:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        with metrics.stage('fetch', self.index_code):
+            res = httpclient.get(url, headers=headers or None)
+        (etag, last_modified) = (res.headers.get('ETag'), res.headers.get('Last-Modified'))
+        if res.status_code == 304:
+            result = saved
+            # 304 通常不带校验头，没有新的时沿用上次保存的
+            etag = etag or meta.get('etag')
+            last_modified = last_modified or meta.get('last_modified')
+        else:
+            with metrics.stage('parse', self.index_code):
+                result = saved.update(self.parse_pbe(res.content))
+            with metrics.stage('persist', self.index_code):
+                if len(saved) > 0:
+                    store.append_changes((saved.days, [saved.values]), (result.days, [result.values]))
+                else:
+                    store.write(result.days, result.values)
+        self.save_meta({
+            'url': url,
+            'time': meta.get('time', time) if period == '1y' else time,
+            'checked': today,
+            'etag': etag,
+            'last_modified': last_modified,
+        })
+        return result
+
+    def parse_pbe(self, content):
+        """ 解析蛋卷的 pe/pb 历史，返回交易日的 ValueSeries """
         pedict = {}
-        header = {}
-        header['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-        header['User-Agent'] += 'AppleWebKit/537.36 (KHTML, like Gecko) '
-        header['User-Agent'] += 'Chrome/79.0.3945.130 Safari/537.36'
-        url = 'https://danjuanapp.com/djapi/'
-        url += 'index_eva/{}_history/{}?day={}'.format(
-            self.index_vq,
-            self.index_code,
-            time)
-        res = requests.get(url=url, headers=header)
         pbe_name = 'index_eva_' + self.index_vq + '_growths'
-        for pe in json.loads(res.content)['data'][pbe_name]:
+        for pe in json.loads(content)['data'][pbe_name]:
             pe['ts'] = datetime.datetime.fromtimestamp(pe['ts'] // 1000)
             pedict.setdefault(pe['ts'], pe[self.index_vq])
-        min_tradeday = min(pedict.keys())
-        max_tradeday = max(pedict.keys())
-        for i in range((max_tradeday - min_tradeday).days):
-            d = min_tradeday + datetime.timedelta(days=i)
-            if d not in pedict.keys():
-                yesterday = d - datetime.timedelta(days=1)
-                pedict[d] = pedict[yesterday]
-        self.pbe = pedict
-        return pedict
+        return ValueSeries.from_dict(pedict)
+
+    def load_meta(self):
+        if not os.path.exists(self.meta_path):
+            return {}
+        try:
+            with open(self.meta_path, 'r') as fr:
+                return json.load(fr)
+        except ValueError:
+            return {}
+
+    def save_meta(self, meta):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as fw:
+            json.dump(meta, fw)
+        os.replace(tmp_path, self.meta_path)
+
+    def get_pbe(self, end_date, default=-1):
+        """ 获取指定日期的 pe/pb，非交易日取前一个交易日的值，超出历史范围返回 default """
+        o = to_ordinal(end_date)
+        i = self.pbe.asof(o)
+        if i < 0 or o > self.pbe.days[-1]:
+            return default
+        return float(self.pbe.values[i])
+
+    def load_pbe_nwater(self, ns=water_lines, day=365*5):
+        """ 一次计算整个 pe/pb 历史每天的多条水位线，之后按日期 O(1) 查询。
+            计算到最后一个交易日之后 30 天，以覆盖节假日后当天的查询。
+        """
+        ns = tuple(n for n in ns if (n, day) not in self.nwater)
+        if ns == () or len(self.pbe) == 0:
+            return self.nwater
+        end_date = self.pbe.last_date() + datetime.timedelta(days=30)
+        nwater = rolling_quantiles(self.pbe, self.pbe.first_date(), end_date, ns, day)
+        for n in ns:
+            self.nwater[(n, day)] = nwater[n]
+        return self.nwater
 
     def get_pbe_nwater(self, end_date, n=30, day=365*5):
         """ 获取指定日期的水位线，默认向前搜索5年
@@ -53,16 +156,39 @@ class Danjuan():
         if end_date is None:
             end_date = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
             end_date = end_date - datetime.timedelta(days=1)
-        pe_value = [
-            self.pbe.get(end_date-datetime.timedelta(days=i), -1)
-            for i in range(0, day)]
-        while -1 in pe_value:
-            pe_value.remove(-1)
-        pe_value.sort()
+        if (n, day) not in self.nwater:
+            self.load_pbe_nwater(self.water_lines if n in self.water_lines else (n,), day)
+        nwater = self.nwater.get((n, day))
+        if nwater is not None and len(nwater) > 0:
+            i = to_ordinal(end_date) - int(nwater.days[0])
+            if 0 <= i < len(nwater) and not math.isnan(nwater.values[i]):
+                return float(nwater.values[i])
+        # 超出预先计算的范围，单独计算
+        o = to_ordinal(end_date)
+        pe_value = sorted(v for v in asof_values(self.pbe, range(o - day + 1, o + 1)).tolist() if v != -1)
         index = len(pe_value) * n // 100
         return pe_value[index]
 
 
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_danjuan(index_code, index_vq):
+    """ 获取进程内共享的 Danjuan 对象，跟踪同一指数的多个基金共用一份 pe/pb 和水位线 """
+    with _indexes_lock:
+        key = (index_code, index_vq)
+        if key not in _indexes:
+            _indexes[key] = Danjuan(index_code, index_vq)
+        return _indexes[key]
+
+
+def clear_danjuans():
+    """ 清空共享的 Danjuan 对象，下次获取时重新加载 """
+    with _indexes_lock:
+        _indexes.clear()
+
+
 if __name__ == '__main__':
 
     index_code = 'SH000300'
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+
+import metrics
+from priceseries import from_ordinal, to_ordinal
+from rolling import RollingRank
+
+# 回撤水位线向前统计的天数，与 Policy.get_dt_revert 一致
+REVERT_DAYS = 360*6
+
+
+class DecisionStream():
+    """ 按日期向前推进，逐个交易日给出购买决策，用于补算购买日志和当天申购。
+
+        与逐日调用 Policy.buy_1dayN 的结果一致，但不再每天重新截取窗口排序：
+        净值排位用 RollingRank 维护窗口，日期前进时只插入和删除进出窗口的值；
+        均值、回撤水位线和 pe 水位线使用预先计算的序列，按日期 O(1) 读取。
+        申购金额由 Policy.decide_1dayN 计算，与逐日计算共用同一套规则。
+
+    Attributes:
+        policy: 已加载净值、回撤和 pe/pb 的 Policy
+        buyfunc: buy_1day1 ~ buy_1day4
+        avgdays: 均值和排位的天数
+        n: 幂，{'price': n, 'pe': n}
+        base: 每天的基础申购金额
+    """
+
+    def __init__(self, policy, buyfunc, avgdays, n, base=100):
+        self.policy = policy
+        self.buyfunc = buyfunc
+        self.avgdays = avgdays
+        self.n = n
+        self.base = base
+        self.reset()
+
+    def reset(self):
+        """ 清空窗口，下次从头开始推进 """
+        self.day = None
+        # 净值窗口 [day-avgdays+1, day) 内的累计净值，price_list 的下标区间为 [price_head, price_tail)
+        self.prices = RollingRank()
+        self.price_head = 0
+        self.price_tail = 0
+
+    def advance(self, o):
+        """ 把净值窗口推进到天序号 o，不能后退，后退时从头重建 """
+        if self.day is not None and o < self.day:
+            self.reset()
+        price_list = self.policy.price_list
+        if self.day is None:
+            # 从窗口起点开始插入
+            self.prices = RollingRank(price_list.ljjz)
+            self.price_head = self.price_tail = price_list.window(o, self.avgdays)[0]
+        self.day = o
+        (days, ljjz) = (price_list.days, price_list.ljjz)
+        while self.price_tail < len(days) and days[self.price_tail] < o:
+            self.prices.add(float(ljjz[self.price_tail]))
+            self.price_tail += 1
+        while self.price_head < self.price_tail and days[self.price_head] < o - self.avgdays + 1:
+            self.prices.remove(float(ljjz[self.price_head]))
+            self.price_head += 1
+
+    def features(self, o, price, revert):
+        """ 由当前窗口计算 fetch_price_info 的各项指标，price 为 (单位净值, 累计净值) """
+        p = self.policy
+        res = {'capital': 0, 'amount': 0, 'price': price}
+        res['avg_price'] = p.get_avg_price(o, 50, self.avgdays)
+        res['revert'] = revert
+        (res['revert_water'], res['revert_length']) = p.get_revert_water(o, revert, REVERT_DAYS)
+        # 窗口加上当天按净值倒序排列，当天的位置为严格大于当天净值的个数
+        res['higher'] = self.prices.count_greater(price[1])
+        length = len(self.prices) + 1
+        res['rank'] = (round(1 - (res['higher'] + 1) * 1.0 / length, 4), length)
+        return res
+
+    def decide(self, o, res):
+        """ 按 buyfunc 计算申购金额和份额，写入 res """
+        p = self.policy
+        cur_price = res['price'][1]
+        if self.buyfunc == 'buy_1day1':
+            decision = p.decide_1day1(cur_price, res['avg_price'][1], self.n, self.base)
+        elif self.buyfunc == 'buy_1day2':
+            decision = p.decide_1day2(cur_price, res['higher'], res['rank'][1], self.n, self.base)
+        elif self.buyfunc == 'buy_1day3':
+            res.update(p.fetch_pe_info(from_ordinal(o)))
+            decision = p.decide_1day3(cur_price, res['avg_price'][1], res['pe'], res['pe30'], self.n, self.base)
+        elif self.buyfunc == 'buy_1day4':
+            decision = p.decide_1day4(cur_price, res['revert'], res['revert_water'], self.n, self.base)
+        else:
+            raise ValueError('unknown buyfunc {}'.format(self.buyfunc))
+        (res['capital'], res['amount']) = decision
+        return res
+
+    def iter(self, begin_date, end_date):
+        """ 依次生成 [begin_date, end_date] 内每个交易日的 (datetime, 决策)，交易日为基金有净值的日期 """
+        price_list = self.policy.price_list
+        revert_list = self.policy.revert_list
+        fid = self.policy.fid
+        (lo, hi) = price_list.span(to_ordinal(begin_date), to_ordinal(end_date) + 1)
+        for i in range(lo, hi):
+            o = int(price_list.days[i])
+            with metrics.stage('features', fid):
+                self.advance(o)
+                res = self.features(o, price_list.value_at(i), revert_list.get(o, 0))
+            with metrics.stage('decide', fid):
+                res = self.decide(o, res)
+            yield (from_ordinal(o), res)
+
+    def live(self):
+        """ 按实时估值计算今天的决策，与 buy_1dayN(None, ...) 一致，估值无效时不申购 """
+        p = self.policy
+        today = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
+        o = to_ordinal(today)
+        price = p.get_gz()
+        # 与 get_dt_price 一致，估值有问题可能是假日，不申购
+        valid = price[0] * 10 > 0
+        if not valid:
+            price = (0, 0)
+        with metrics.stage('features', p.fid):
+            self.advance(o)
+            res = self.features(o, price, p.get_revert(None, price[1]))
+        if not valid:
+            res['avg_price'] = (0, 0)
+        with metrics.stage('decide', p.fid):
+            return self.decide(o, res)
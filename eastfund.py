@@ -1,10 +1,17 @@
 # -*- coding:utf-8 -*-
 
-import requests
 import datetime
 import json
 import re
 import math
+import threading
+
+import estimate
+import httpclient
+import metrics
+from priceseries import PriceSeries, ValueSeries, to_ordinal
+from rolling import rolling_avg_price, rolling_revert, rolling_revert_water
+from store import DayStore
 
 
 class EastFund():
@@ -14,10 +21,24 @@ class EastFund():
         fid 为基金编码，nav为基金净值，nav2为累计净值。
     """
 
+    # 接口地址，测试时可以替换为本地服务
+    lsjz_url = 'http://api.fund.eastmoney.com/f10/lsjz'
+    gz_url = 'http://fundgz.1234567.com.cn/js/{}.js'
+
     def __init__(self, fid):
         self.fid = str(fid)
-        self.price_list = {}
-        self.revert_list = {}
+        self.price_list = PriceSeries()
+        self.revert_list = ValueSeries()
+        self.avg_cache = {}
+        self.avg_cache_src = None
+        self.water_cache = {}
+        self.water_cache_src = None
+        self.delta = None
+        self.delta_src = None
+        self.loaded_date = None
+        # 只读取本地最近 tail_days 天的记录，None 为全部读取
+        self.tail_days = None
+        self.lock = threading.RLock()
         self.record_path = './record.' + str(fid)
         self.buylog_path = './buylog.' + str(fid)
         self.revert_path = './revert.' + str(fid)
@@ -29,28 +50,53 @@ class EastFund():
                 response.content.decode('utf-8'),
                 re.S).group(1))
 
+    def since(self):
+        """ 只读取最近 tail_days 天时返回起始天序号，否则返回 None """
+        if self.tail_days is None:
+            return None
+        return datetime.date.today().toordinal() - self.tail_days
+
+    def covers(self, begin_date, days):
+        """ begin_date 之前 days 天的窗口是否都在读取的范围内，读取全部记录时总是 True """
+        since = self.since()
+        return since is None or to_ordinal(begin_date) - days >= since
+
+    def load_all(self):
+        """ 只读取了最近 tail_days 天时，改为读取全部本地记录并重新加载净值。
+            计算并保存的日期窗口超出读取范围时先调用，否则窗口不完整，保存的结果是错的。
+        """
+        if self.tail_days is None:
+            return
+        self.tail_days = None
+        end_date = self.loaded_date
+        self.loaded_date = None
+        self.load_fundprice(end_date)
+
     def get_fundprice(self, start_date=None, end_date=None):
         """ 获取指定基金的净值，可以获取当前净值和累计净值 """
         sdate = '' if start_date is None else start_date.strftime('%Y-%m-%d')
         edate = '' if end_date is None else end_date.strftime('%Y-%m-%d')
         fid = self.fid
         result = []
-        url = 'http://api.fund.eastmoney.com/f10/lsjz?callback=jQuery&pageIndex=1&'
-        url += 'pageSize=20&startDate={}&endDate={}&fundCode={}'.format(sdate, edate, fid)
+        url = self.lsjz_url + '?callback=jQuery&pageIndex=1&'
+        url += 'pageSize={}&startDate={}&endDate={}&fundCode={}'
         header = {}
-        header['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-        header['User-Agent'] += 'AppleWebKit/537.36 (KHTML, like Gecko) '
-        header['User-Agent'] += 'Chrome/79.0.3945.130 Safari/537.36'
         header['Referer'] = 'http://fundf10.eastmoney.com/jjjz_' + fid + '.html'
-        res = requests.get(url=url, headers=header)
-        total_number = self.parse_jsonp(res)['TotalCount']
-        if total_number > 20:
-            url = 'http://api.fund.eastmoney.com/f10/lsjz?callback=jQuery&pageIndex=1&'
-            url += 'pageSize={}&startDate={}&endDate={}&fundCode={}'.format(str(total_number), sdate, edate, fid)
-            res = requests.get(url=url, headers=header)
-        finfo = self.parse_jsonp(res)['Data']['LSJZList']
-        for f in finfo:
-            result.append((fid, f['FSRQ'], float(f['DWJZ']), float(f['LJJZ'])))
+        # 已知起止日期时，净值条数不会超过自然日天数，直接取一页，省去探测总数的请求
+        if start_date is not None and end_date is not None:
+            page_size = max((end_date - start_date).days + 1, 1)
+        else:
+            page_size = 20
+        with metrics.stage('fetch', fid):
+            res = httpclient.get(url.format(page_size, sdate, edate, fid), headers=header)
+            total_number = self.parse_jsonp(res)['TotalCount']
+            if total_number > page_size:
+                res = httpclient.get(url.format(total_number, sdate, edate, fid), headers=header)
+        with metrics.stage('parse', fid):
+            finfo = self.parse_jsonp(res)['Data']['LSJZList']
+            for f in finfo:
+                result.append((fid, f['FSRQ'], float(f['DWJZ']), float(f['LJJZ'])))
+        metrics.count('records_fetched', len(result), fid)
         return result
 
     def get_revert(self, end_date=None, cur_price=-1, days=360):
@@ -67,171 +113,240 @@ class EastFund():
             price = self.price_list.get(end_date, (0, 0))
         if price[1] == 0:
             return 0
-        p_list = []
-        for i in range(1, days):
-            d = end_date - datetime.timedelta(days=i)
-            p_list.append(self.price_list.get(d, (0, 0))[1])
-        if max(p_list) <= price[1]:
+        (lo, hi) = self.price_list.window(end_date, days)
+        if lo == hi:
+            return 0
+        max_price = float(self.price_list.ljjz[lo:hi].max())
+        if max_price <= price[1]:
             return 0
         else:
-            return round((max(p_list) - price[1]) / max(p_list) * 100, 4)
-
-    def save_fundprice(self, fprice):
-        """ 保存基金的净值，可以获取当前净值和累计净值 """
-        with open(self.record_path, 'w') as fw:
-            for d in sorted(fprice.keys()):
-                result = []
-                result.append(self.fid)
-                result.append(d.strftime('%Y-%m-%d'))
-                result.append(str(fprice[d][0]))
-                result.append(str(fprice[d][1]))
-                line = ','.join(result)
-                fw.write(line)
-                fw.write('\n')
-
-    def save_revert(self, fprice):
-        """ 保存基金的回撤 """
-        with open(self.revert_path, 'w') as fw:
-            for d in sorted(fprice.keys()):
-                result = []
-                result.append(self.fid)
-                result.append(d.strftime('%Y-%m-%d'))
-                result.append(str(fprice[d]))
-                line = ','.join(result)
-                fw.write(line)
-                fw.write('\n')
+            return round((max_price - price[1]) / max_price * 100, 4)
+
+    def save_fundprice(self, fprice, saved=None):
+        """ 保存基金的净值，可以获取当前净值和累计净值。
+            saved 为文件中已有的净值时，只追加新增或有变化的记录，否则重写整个文件。
+        """
+        if not isinstance(fprice, PriceSeries):
+            fprice = PriceSeries.from_dict(fprice)
+        store = DayStore(self.record_path, 2)
+        with metrics.stage('persist', self.fid):
+            if saved is None:
+                store.write(fprice.days, fprice.nav, fprice.ljjz)
+            else:
+                store.append_changes(
+                    (saved.days, [saved.nav, saved.ljjz]), (fprice.days, [fprice.nav, fprice.ljjz]))
+
+    def save_revert(self, fprice, saved=None):
+        """ 保存基金的回撤。
+            saved 为文件中已有的回撤时，只追加新增或有变化的记录，否则重写整个文件。
+        """
+        if not isinstance(fprice, ValueSeries):
+            fprice = ValueSeries.from_dict(fprice)
+        store = DayStore(self.revert_path, 1)
+        with metrics.stage('persist', self.fid):
+            if saved is None:
+                store.write(fprice.days, fprice.values)
+            else:
+                store.append_changes((saved.days, [saved.values]), (fprice.days, [fprice.values]))
 
     def load_fundprice(self, end_date=None):
-        result = {}
+        """ 加载基金净值，本地记录不够新则从网上补齐。
+            本次运行内已经加载到 end_date，则直接返回已加载的净值。
+        """
         if end_date is None:
             n = datetime.datetime.now() - datetime.timedelta(days=1)
             end_date = datetime.datetime(n.year, n.month, n.day, 0, 0, 0)
-        max_dt = datetime.datetime(1970, 1, 1)
+        with self.lock:
+            # price_list 被删除后（见 policy.LazyData）重新加载
+            if self.loaded_date is None or end_date > self.loaded_date or 'price_list' not in self.__dict__:
+                with metrics.stage('load', self.fid):
+                    self.update_fundprice(end_date)
+                self.loaded_date = end_date
+            return self.price_list
+
+    def update_fundprice(self, end_date):
+        """ 读取本地净值记录，不够新则从网上补齐并保存 """
         try:
-            fr = open(self.record_path, 'r')
-            for line in fr.readlines():
-                arr = line.strip().split(',')
-                d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                max_dt = d if d > max_dt else max_dt
-                result[d] = (float(arr[2]), float(arr[3]))
-            fr.close()
+            (days, (nav, ljjz)) = DayStore(self.record_path, 2).load(self.since())
+            result = PriceSeries(days, nav, ljjz)
+            max_dt = result.last_date() if len(result) > 0 else datetime.datetime(1970, 1, 1)
             if end_date <= max_dt:
                 print('No need fetch new record')
                 self.price_list = result
-                return result
+                return self.price_list
             else:
                 print('Need fetch new record')
                 fprice = self.get_fundprice(max_dt, end_date)
-                for arr in fprice:
-                    d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                    result[d] = (float(arr[2]), float(arr[3]))
-                self.save_fundprice(result)
-                self.price_list = result
-                return result
+                self.price_list = result.update(self.parse_fundprice(fprice))
+                self.save_fundprice(self.price_list, result)
+                return self.price_list
         except Exception:
             print('First fetch record')
             fprice = self.get_fundprice()
-            for arr in fprice:
-                d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                result[d] = (float(arr[2]), float(arr[3]))
-            self.save_fundprice(result)
-            self.price_list = result
-            return result
+            self.price_list = self.parse_fundprice(fprice)
+            self.save_fundprice(self.price_list)
+            return self.price_list
+
+    def parse_fundprice(self, fprice):
+        """ 将 get_fundprice 的结果转为 PriceSeries """
+        with metrics.stage('parse', self.fid):
+            return PriceSeries.from_records(
+                (datetime.datetime.strptime(arr[1], '%Y-%m-%d'), arr[2], arr[3]) for arr in fprice)
 
     def load_revert(self, end_date=None, days=360):
-        result = {}
         if end_date is None:
             n = datetime.datetime.now() - datetime.timedelta(days=1)
             end_date = datetime.datetime(n.year, n.month, n.day, 0, 0, 0)
-        max_dt = datetime.datetime(1970, 1, 1)
+        # 只计算到最后一天净值，尚未公布净值的日期留到下次运行，否则会保存为 0 且不再重新计算
+        last_date = end_date
+        if len(self.price_list) > 0:
+            last_date = min(end_date, self.price_list.last_date())
         try:
-            fr = open(self.revert_path, 'r')
-            for line in fr.readlines():
-                arr = line.strip().split(',')
-                d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                max_dt = d if d > max_dt else max_dt
-                result[d] = float(arr[2])
-            fr.close()
-            if end_date <= max_dt:
+            (rdays, (values, )) = DayStore(self.revert_path, 1).load(self.since())
+            result = ValueSeries(rdays, values)
+            max_dt = result.last_date() if len(result) > 0 else datetime.datetime(1970, 1, 1)
+            if last_date <= max_dt:
                 print('No need fetch new record')
                 self.revert_list = result
-                return result
+                return self.revert_list
             else:
                 print('Need fetch new record')
-                for i in range(0, (end_date - max_date).days):
-                    d = max_date + datetime.timedelta(days=i)
-                    result[d] = self.get_revert(d, days)
-                self.save_revert(result)
-                self.revert_list = result
-                return result
+                if not self.covers(max_dt + datetime.timedelta(days=1), days):
+                    self.load_all()
+                # 只计算 max_dt 之后的新日期
+                with metrics.stage('revert', self.fid):
+                    reverts = rolling_revert(self.price_list, max_dt + datetime.timedelta(days=1), last_date, days)
+                self.revert_list = result.update(reverts)
+                self.save_revert(self.revert_list, result)
+                return self.revert_list
         except Exception:
             print('First fetch revert')
-            for i in range(0, 3600):
-                d = end_date - datetime.timedelta(days=i)
-                result[d] = self.get_revert(d, days)
-            self.save_revert(result)
-            self.revert_list = result
-            return result
+            begin_date = end_date - datetime.timedelta(days=3599)
+            if not self.covers(begin_date, days):
+                self.load_all()
+            with metrics.stage('revert', self.fid):
+                self.revert_list = rolling_revert(self.price_list, begin_date, last_date, days)
+            self.save_revert(self.revert_list)
+            return self.revert_list
 
     def get_delta_price(self, end_date=None):
-        price = self.load_fundprice(end_date)
-        max_dt = max(price.keys())
-        # 基金分红
-        delta_price = price[max_dt][1] - price[max_dt][0]
-        flag = True
-        # 基金分拆
-        if self.fid in ('160218', '161725', '162412'):
-            delta_price = price[max_dt][1] / price[max_dt][0]
-            flag = False
-        return (delta_price, flag)
+        """ 由最新一天的净值计算分红差价或分拆比例，返回 (差价, 是否为差价)。
+            已加载净值时直接使用，按净值对象缓存，不重新读取文件。
+        """
+        price = self.price_list if len(self.price_list) > 0 else self.load_fundprice(end_date)
+        if self.delta_src is not price:
+            (nav, ljjz) = price.value_at(len(price) - 1)
+            # 基金分红
+            delta = (ljjz - nav, True)
+            # 基金分拆
+            if self.fid in ('160218', '161725', '162412'):
+                delta = (ljjz / nav, False)
+            (self.delta, self.delta_src) = (delta, price)
+        return self.delta
 
     def get_gz(self):
-        """ 获取当前时间的估值 """
-        fid = self.fid
-        url = 'http://fundgz.1234567.com.cn/js/' + fid + '.js'
-        header = {}
-        header['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
-        header['User-Agent'] += ' AppleWebKit/537.36 (KHTML, like Gecko)'
-        header['User-Agent'] += ' Chrome/79.0.3945.130 Safari/537.36'
-        (delta_price, flag) = self.get_delta_price()
+        """ 获取当前时间的估值，由 estimate 统一请求，ttl 内同一基金只请求一次 """
+        return estimate.get(self)
+
+    def fetch_gsz(self):
+        """ 请求当前时间的估算净值，不是今天的估值或请求失败时返回 None """
+        url = self.gz_url.format(self.fid)
         try:
-            res = requests.get(url=url, headers=header)
+            with metrics.stage('fetch', self.fid):
+                res = httpclient.get(url)
             gz_dict = self.parse_jsonp(res)
             dnow = datetime.datetime.now().strftime('%Y-%m-%d')
             if dnow != gz_dict['gztime'].split(' ')[0]:
-                return (0, 0)
-            if flag is True:
-                return (float(gz_dict['gsz']), round(float(gz_dict['gsz']) + delta_price, 4))
-            else:
-                return (float(gz_dict['gsz']), round(float(gz_dict['gsz']) * delta_price, 4))
+                return None
+            return float(gz_dict['gsz'])
         except Exception as e:
             print(e)
-            return (0, 0)
+            return None
+
+    def load_avg_price(self, n=50, day=365):
+        """ 预先计算整个净值区间每天的均值或 n 分位数，按 (n, day) 缓存，净值更新后重新计算。
+        """
+        if self.avg_cache_src is not self.price_list:
+            self.avg_cache = {}
+            self.avg_cache_src = self.price_list
+        if (n, day) not in self.avg_cache:
+            if len(self.price_list) == 0:
+                self.avg_cache[(n, day)] = PriceSeries()
+            else:
+                begin_date = self.price_list.first_date()
+                end_date = self.price_list.last_date() + datetime.timedelta(days=1)
+                self.avg_cache[(n, day)] = rolling_avg_price(self.price_list, begin_date, end_date, n, day)
+        return self.avg_cache[(n, day)]
 
     def get_avg_price(self, end_date, n=50, day=365):
         """ 获取1年的均值。
         """
-        total = [0, 0]
-        dwjz = []
-        ljjz = []
-        prices = [
-            self.price_list[end_date-datetime.timedelta(days=i)]
-            for i in range(1, day)
-            if end_date-datetime.timedelta(days=i) in self.price_list]
-        if prices == []:
-            return (0, 0)
-        for i in prices:
-            dwjz.append(i[0])
-            ljjz.append(i[1])
-            total[0] = total[0] + i[0]
-            total[1] = total[1] + i[1]
-        if n == 50:
-            return (total[0]/len(prices), total[1]/len(prices))
-        else:
-            dwjz.sort()
-            ljjz.sort()
-            index = len(dwjz)*n//100-1
-            return (dwjz[index], ljjz[index])
+        avg = self.load_avg_price(n, day)
+        if len(avg) > 0:
+            i = to_ordinal(end_date) - int(avg.days[0])
+            if 0 <= i < len(avg):
+                return avg.value_at(i)
+        return rolling_avg_price(self.price_list, end_date, end_date, n, day).value_at(0)
+
+    def load_revert_water(self, days=360*6):
+        """ 预先计算整个回撤区间每天回撤的水位线，计算到最后一天之后一天，以覆盖当天的实时回撤。
+            按 days 缓存，回撤更新后重新计算。返回 (水位线, 窗口长度, 最后一天的窗口)。
+        """
+        if self.water_cache_src is not self.revert_list:
+            self.water_cache = {}
+            self.water_cache_src = self.revert_list
+        if days not in self.water_cache:
+            if len(self.revert_list) == 0:
+                self.water_cache[days] = (ValueSeries(), ValueSeries(), None)
+            else:
+                (begin, end) = (int(self.revert_list.days[0]), int(self.revert_list.days[-1]) + 1)
+                self.water_cache[days] = rolling_revert_water(self.revert_list, begin, end, days)
+        return self.water_cache[days]
+
+    def get_revert_water(self, end_date, revert, days=360*6):
+        """ 获取 end_date 当天回撤 revert 在之前 days-1 天正回撤中的水位线，返回 (水位线, 窗口长度)。
+            revert 与 revert_list 中当天的值相同时直接读取，否则视为当天的实时回撤，用最后一天的窗口计算。
+        """
+        (water, count, window) = self.load_revert_water(days)
+        o = to_ordinal(end_date)
+        if len(water) > 0:
+            i = o - int(water.days[0])
+            if 0 <= i < len(water):
+                length = int(count.values[i])
+                if revert <= 0:
+                    return (0, length)
+                if revert == self.revert_list.get(o, 0):
+                    return (float(water.values[i]), length + 1)
+                if i == len(water) - 1:
+                    return (round((window.count_less(revert) + 1) * 1.0 / (length + 1), 4), length + 1)
+        # 超出预先计算的范围，单独计算
+        (lo, hi) = self.revert_list.window(o, days)
+        reverts = self.revert_list.values[lo:hi]
+        reverts = reverts[reverts > 0]
+        if revert <= 0:
+            return (0, len(reverts))
+        return (round((int((reverts < revert).sum()) + 1) * 1.0 / (len(reverts) + 1), 4), len(reverts) + 1)
+
+
+_funds = {}
+_funds_lock = threading.Lock()
+
+
+def get_fund(fid):
+    """ 获取进程内共享的 EastFund 对象，同一基金只创建一个，
+        其净值和估值在本次运行内只加载一次，被多个基金组合共用。
+    """
+    fid = str(fid)
+    with _funds_lock:
+        if fid not in _funds:
+            _funds[fid] = EastFund(fid)
+        return _funds[fid]
+
+
+def clear_funds():
+    """ 清空共享的 EastFund 对象，下次获取时重新加载 """
+    with _funds_lock:
+        _funds.clear()
 
 
 if __name__ == '__main__':
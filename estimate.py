@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 估值的缓存时间（秒），同一次运行内重复使用，盘中长时间运行时过期后重新请求
+ttl = 60
+
+_lock = threading.Lock()
+# {基金代码: (请求时间, 估算净值)}，估算净值为 None 表示估值无效（不是今天的估值或请求失败）
+_cache = {}
+# {基金代码: Lock}，同一基金同时只有一个线程请求，其余线程等待结果
+_fid_locks = {}
+
+
+def fid_lock(fid):
+    with _lock:
+        if fid not in _fid_locks:
+            _fid_locks[fid] = threading.Lock()
+        return _fid_locks[fid]
+
+
+def cached(fid):
+    """ 返回 (是否命中, 估算净值) """
+    with _lock:
+        if fid in _cache:
+            (t, gsz) = _cache[fid]
+            if time.time() - t < ttl:
+                return (True, gsz)
+    return (False, None)
+
+
+def fetch(fund):
+    """ 获取基金的估算净值，ttl 内同一基金只请求一次 """
+    (hit, gsz) = cached(fund.fid)
+    if hit:
+        return gsz
+    with fid_lock(fund.fid):
+        (hit, gsz) = cached(fund.fid)
+        if hit:
+            return gsz
+        gsz = fund.fetch_gsz()
+        with _lock:
+            _cache[fund.fid] = (time.time(), gsz)
+        return gsz
+
+
+def prefetch(funds, workers=8):
+    """ 并发获取一组基金的估值，已缓存或重复的基金跳过，站点并发数由 httpclient.host_limits 限制 """
+    todo = {}
+    for fund in funds:
+        if fund.fid not in todo and not cached(fund.fid)[0]:
+            todo[fund.fid] = fund
+    if len(todo) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+        list(pool.map(fetch, todo.values()))
+
+
+def get(fund):
+    """ 返回 (估算净值, 估算累计净值)，估值无效时为 (0, 0) """
+    gsz = fetch(fund)
+    if gsz is None:
+        return (0, 0)
+    (delta_price, flag) = fund.get_delta_price()
+    if flag is True:
+        return (gsz, round(gsz + delta_price, 4))
+    else:
+        return (gsz, round(gsz * delta_price, 4))
+
+
+def clear():
+    with _lock:
+        _cache.clear()
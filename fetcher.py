@@ -0,0 +1,47 @@
+# -*- coding:utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+
+import estimate
+import metrics
+
+
+def run_stage(pool, tasks):
+    """ 并发执行一组任务，等待全部完成，有异常则抛出 """
+    futures = [pool.submit(func, *args) for (func, args) in tasks]
+    return [f.result() for f in futures]
+
+
+def fetch_all(policies, workers=8):
+    """ 在策略计算之前并发获取所有基金的净值、实时估值和指数 pe/pb，并加载回撤。
+
+        同一基金（包括多个基金组合共有的成分基金）只请求一次，各站点的并发数由 httpclient.host_limits 限制。
+        完成后 policies 可以直接用于 dt 为 None 的当天申购计算。
+    """
+    # 按基金代码分组，每组由第一个对象负责请求。
+    # 基金组合的成分基金是共享对象（见 eastfund.get_fund），同一对象只保留一次。
+    groups = {}
+    for p in policies:
+        members = p.members if p.funds != [] else [p]
+        for east in members:
+            group = groups.setdefault(east.fid, [])
+            if all(east is not e for e in group):
+                group.append(east)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # 净值和 pe/pb 互不依赖，一起获取
+        tasks = [(group[0].load_fundprice, ()) for group in groups.values()]
+        tasks += [(p.fetch_index_pbe, ()) for p in policies if p.index['code'] != '']
+        run_stage(pool, tasks)
+        for group in groups.values():
+            for east in group[1:]:
+                east.price_list = group[0].price_list
+    # 估值按基金代码缓存，同组的对象共用，分红差价在使用时由已加载的净值计算
+    estimate.prefetch([group[0] for group in groups.values()], workers)
+    # 以下只读写本地文件
+    for p in policies:
+        with metrics.stage('load', p.fid):
+            if p.funds != []:
+                p.load_xnjz()
+            p.load_revert()
+            p.init_index_pbe()
+    return policies
@@ -1,7 +1,14 @@
 # -*- coding:utf-8 -*-
 
 import datetime
-from eastfund import EastFund
+
+import numpy as np
+
+import estimate
+from backtest import py_round
+from eastfund import EastFund, get_fund
+from priceseries import PriceSeries, to_ordinal
+from store import DayStore
 
 
 class Fof(EastFund):
@@ -9,11 +16,17 @@ class Fof(EastFund):
 
     Attributes:
         fid 为基金组合代码
+        funds 为当前的成分基金及其占比
+        rebalances 为调仓记录，[(开始日期, funds)]，第一条的开始日期为 None，没有调仓则为空
+        members 为历次成分基金对应的共享 EastFund 对象，见 get_fund
+        xnjz 为成分基金按占比合成的虚拟净值，ratio 为虚拟净值与组合净值的比例
     """
 
     def __init__(self, fid=''):
         EastFund.__init__(self, fid)
-        self.xnjz = {}
+        self.xnjz = PriceSeries()
+        self.ratio = PriceSeries()
+        self.rebalances = []
         if fid == 'njbqg':
             self.funds = [
                 {'fid': '001975', 'p': 12},
@@ -55,52 +68,105 @@ class Fof(EastFund):
             ]
         else:
             self.funds = []
+        self.members = [get_fund(f['fid']) for f in self.funds]
+
+    def rebalance(self, start_date, funds):
+        """ 记录组合调仓，start_date 起按 funds 的占比计算虚拟净值，之前沿用原来的占比 """
+        if self.rebalances == []:
+            self.rebalances.append((None, self.funds))
+        self.rebalances.append((start_date, funds))
+        self.rebalances.sort(key=lambda r: datetime.datetime.min if r[0] is None else r[0])
+        self.funds = self.rebalances[-1][1]
+        fids = []
+        for (_, funds) in self.rebalances:
+            fids += [f['fid'] for f in funds if f['fid'] not in fids]
+        self.members = [get_fund(fid) for fid in fids]
+
+    def weight_matrix(self, days):
+        """ 返回 days × members 的占比矩阵，每行为当天各成分基金的占比（百分数，与 funds 的 p 相同） """
+        fids = [east.fid for east in self.members]
+        periods = self.rebalances if self.rebalances != [] else [(None, self.funds)]
+        weights = np.zeros((len(periods), len(fids)))
+        for (i, (_, funds)) in enumerate(periods):
+            for f in funds:
+                weights[i, fids.index(f['fid'])] = f['p']
+        starts = [to_ordinal(d) for (d, _) in periods[1:]]
+        return weights[np.searchsorted(starts, days, side='right')]
 
     def load_fundprice(self, end_date=None):
         if self.funds == []:
             return EastFund.load_fundprice(self, end_date)
         else:
-            fr = open(self.record_path, 'r')
-            for line in fr.readlines():
-                arr = line.strip().split(',')
-                d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                self.price_list[d] = (float(arr[2]), float(arr[2]))
-            fr.close()
-            jz = {}
-            for f in self.funds:
-                east = EastFund(f['fid'])
-                fprice = east.load_fundprice(end_date)
-                for k in fprice.keys():
-                    if k not in jz:
-                        jz[k] = [0, 0]
-                    jz[k][0] = jz[k][0] + fprice[k][0] * f['p'] / 100
-                    jz[k][1] = jz[k][1] + fprice[k][1] * f['p'] / 100
-            for k in jz:
-                jz[k][0] = round(jz[k][0], 4)
-                jz[k][1] = round(jz[k][1], 4)
-            self.xnjz = jz
-            return jz
+            for east in self.members:
+                east.load_fundprice(end_date)
+            return self.load_xnjz()
+
+    def load_xnjz(self, missing='ffill'):
+        """ 读取组合净值，并由已加载的成分基金净值按占比计算虚拟净值 xnjz 和跟踪比例 ratio。
+
+            日期 × 成分基金的净值矩阵与占比矩阵相乘，按成分基金的顺序逐列累加，日期取所有成分基金交易日的并集。
+            累加顺序、净值 * p / 100 的算法和 round 取整都与逐日计算相同，结果一致。
+            missing 为 ffill 时，成分基金当天没有净值则沿用之前最近的净值，仍然没有（尚未成立）的
+            按其余基金的占比重新分配；missing 为 renorm 时，只按当天有净值的基金重新分配。
+        """
+        # 组合记录为手工维护的 csv，只有单位净值，累计净值与其相同
+        store = DayStore(self.record_path, 2)
+        store.merge_csv()
+        (days, (nav, ljjz)) = store.load(self.since())
+        self.price_list = PriceSeries(days, nav, ljjz)
+        days = np.unique(np.concatenate([east.price_list.days for east in self.members]))
+        nav = np.zeros((len(days), len(self.members)))
+        ljjz = np.zeros((len(days), len(self.members)))
+        valid = np.zeros((len(days), len(self.members)), dtype=bool)
+        for (j, east) in enumerate(self.members):
+            fprice = east.price_list
+            if len(fprice) == 0:
+                continue
+            idx = np.searchsorted(fprice.days, days, side='right') - 1
+            valid[:, j] = idx >= 0
+            if missing == 'renorm':
+                valid[:, j] &= fprice.days[np.maximum(idx, 0)] == days
+            nav[valid[:, j], j] = fprice.nav[idx[valid[:, j]]]
+            ljjz[valid[:, j], j] = fprice.ljjz[idx[valid[:, j]]]
+        weights = self.weight_matrix(days)
+        present = (weights * valid).sum(axis=1)
+        keep = present > 0
+        # 所有成分基金都有净值时 scale 为 1，不改变累加的结果
+        scale = weights.sum(axis=1)[keep] / present[keep]
+        (xnav, xljjz) = (np.zeros(len(days)), np.zeros(len(days)))
+        for j in range(len(self.members)):
+            xnav += nav[:, j] * weights[:, j] / 100
+            xljjz += ljjz[:, j] * weights[:, j] / 100
+        xnav = xnav[keep] * scale
+        xljjz = xljjz[keep] * scale
+        self.xnjz = PriceSeries(days[keep], py_round(xnav, 4), py_round(xljjz, 4))
+        (common, i, j) = np.intersect1d(self.xnjz.days, self.price_list.days, return_indices=True)
+        self.ratio = PriceSeries(
+            common,
+            self.xnjz.nav[i] / self.price_list.nav[j],
+            self.xnjz.ljjz[i] / self.price_list.ljjz[j])
+        return self.xnjz
 
     def get_gz(self):
         if self.funds == []:
             return EastFund.get_gz(self)
         else:
             gz = [0, 0]
-            for f in self.funds:
-                east = EastFund(f['fid'])
-                east.load_fundprice()
+            # 成分基金的估值一起并发请求
+            funds = [get_fund(f['fid']) for f in self.funds]
+            estimate.prefetch(funds)
+            for (f, east) in zip(self.funds, funds):
                 fprice = east.get_gz()
                 if fprice[0] == 0:
                     continue
                 gz[0] = gz[0] + fprice[0] * f['p'] / 100
                 gz[1] = gz[1] + fprice[1] * f['p'] / 100
-            for i in range(1, 30):
-                d = datetime.datetime.now()
-                d = datetime.datetime(d.year, d.month, d.day, 0, 0, 0) - datetime.timedelta(days=i)
-                if d in self.xnjz and d in self.price_list:
-                    ratio0 = self.xnjz[d][0] / self.price_list[d][0]
-                    ratio1 = self.xnjz[d][1] / self.price_list[d][1]
-                    break
+            # 取最近 30 天内最后一个跟踪比例
+            today = datetime.date.today()
+            (lo, hi) = self.ratio.span(to_ordinal(today) - 29, today)
+            if lo == hi:
+                return (0, 0)
+            (ratio0, ratio1) = self.ratio.value_at(hi - 1)
             gz[0] = round(gz[0] / ratio0, 4)
             gz[1] = round(gz[1] / ratio1, 4)
             return gz
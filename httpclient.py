@@ -0,0 +1,108 @@
+# -*- coding:utf-8 -*-
+
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 每个站点同时进行的最大请求数，未列出的站点使用 default
+host_limits = {
+    'api.fund.eastmoney.com': 4,
+    'fundgz.1234567.com.cn': 4,
+    'danjuanapp.com': 2,
+    'default': 4,
+}
+
+# 失败重试次数，第 i 次重试前等待 backoff * 2 ** i 秒
+retries = 3
+backoff = 0.5
+retry_status = (429, 500, 502, 503, 504)
+timeout = 10
+
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+user_agent += 'AppleWebKit/537.36 (KHTML, like Gecko) '
+user_agent += 'Chrome/79.0.3945.130 Safari/537.36'
+
+# 记录响应的回调 recorder(url, response)，见 replay.Recorder，None 为不记录
+recorder = None
+
+_lock = threading.Lock()
+_semaphores = {}
+_session = None
+# 按站点统计：请求数、重试数、失败数、响应字节数、耗时
+_stats = {}
+
+
+def host_semaphore(host):
+    """ 获取站点对应的信号量，用于限制并发请求数 """
+    with _lock:
+        if host not in _semaphores:
+            limit = host_limits.get(host, host_limits['default'])
+            _semaphores[host] = threading.BoundedSemaphore(limit)
+        return _semaphores[host]
+
+
+def get_session():
+    """ 获取共享的 Session，同一站点复用 keep-alive 连接 """
+    global _session
+    with _lock:
+        if _session is None:
+            pool_size = max(host_limits.values())
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(host_limits), pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = user_agent
+            _session = session
+        return _session
+
+
+def count(host, key, value=1):
+    with _lock:
+        stat = _stats.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0})
+        stat[key] += value
+
+
+def get_stats():
+    """ 返回按站点统计的请求数、重试数、失败数、响应字节数和耗时 """
+    with _lock:
+        return dict((host, dict(stat)) for (host, stat) in _stats.items())
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+
+
+def get(url, headers=None, **kwargs):
+    """ 发送 GET 请求。
+        同一站点的并发数受 host_limits 限制，连接异常或 retry_status 状态码会按 backoff 退避重试。
+    """
+    host = urlparse(url).netloc
+    kwargs.setdefault('timeout', timeout)
+    session = get_session()
+    for i in range(retries + 1):
+        if i > 0:
+            count(host, 'retries')
+            time.sleep(backoff * 2 ** (i - 1))
+        start = time.time()
+        try:
+            with host_semaphore(host):
+                res = session.get(url, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            count(host, 'seconds', time.time() - start)
+            if i == retries:
+                count(host, 'errors')
+                raise
+            continue
+        count(host, 'requests')
+        count(host, 'bytes', len(res.content))
+        count(host, 'seconds', time.time() - start)
+        if res.status_code not in retry_status:
+            if recorder is not None and res.status_code == 200:
+                recorder(url, res)
+            return res
+    count(host, 'errors')
+    return res
@@ -0,0 +1,166 @@
+# -*- coding:utf-8 -*-
+
+""" 每日运行的分阶段计时和计数。
+
+    with metrics.stage('fetch', fid):
+        ...
+    metrics.count('buylog_days', len(days), fid)
+
+    阶段：fetch 请求，parse 解析，load 读取和补齐本地记录，revert 计算回撤，buylog 补算购买日志，
+    features 计算指标，decide 计算申购金额，persist 写文件，mail 发送邮件。
+    阶段可以嵌套，耗时包含嵌套的阶段，如 load 包含 fetch、parse 和 persist。
+    未启用时 stage 返回同一个空对象，count 直接返回，开销只有一次函数调用。
+    结果可以导出为 json 报告或 Prometheus 文本格式，httpclient 的按站点统计一并导出。
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+
+import httpclient
+
+enabled = False
+
+_lock = threading.Lock()
+# {(阶段, 基金代码): [次数, 总耗时, 最大耗时]}
+_stages = {}
+# {(名称, 基金代码): 数值}
+_counters = {}
+_started = time.time()
+
+
+class Timer():
+    __slots__ = ('key', 'start')
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            stat = _stages.get(self.key)
+            if stat is None:
+                _stages[self.key] = [1, seconds, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += seconds
+                stat[2] = max(stat[2], seconds)
+        return False
+
+
+class NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null = NullTimer()
+
+
+def stage(name, fund=''):
+    """ 返回计时的上下文，fund 为基金或指数代码，不区分基金时为空 """
+    if not enabled:
+        return _null
+    return Timer((name, fund))
+
+
+def count(name, value=1, fund=''):
+    if not enabled:
+        return
+    with _lock:
+        key = (name, fund)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    global _started
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _started = time.time()
+    httpclient.reset_stats()
+
+
+def report():
+    """ 返回运行报告：各阶段的次数和耗时、计数和按站点的请求统计 """
+    with _lock:
+        stages = [
+            {'stage': name, 'fund': fund, 'calls': stat[0], 'seconds': round(stat[1], 6), 'max': round(stat[2], 6)}
+            for ((name, fund), stat) in sorted(_stages.items())]
+        counters = [
+            {'name': name, 'fund': fund, 'value': value}
+            for ((name, fund), value) in sorted(_counters.items())]
+    return {
+        'time': datetime.datetime.fromtimestamp(_started).strftime('%Y-%m-%d %H:%M:%S'),
+        'elapsed': round(time.time() - _started, 3),
+        'stages': stages,
+        'counters': counters,
+        'http': httpclient.get_stats(),
+    }
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus(res=None, prefix='fundvalue'):
+    """ 把运行报告转为 Prometheus 文本格式 """
+    res = report() if res is None else res
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for (labels, value) in samples:
+            text = ','.join('{}="{}"'.format(k, label(v)) for (k, v) in labels)
+            if text != '':
+                text = '{' + text + '}'
+            lines.append('{}_{}{} {}'.format(prefix, name, text, value))
+
+    stage_labels = [((('stage', s['stage']), ('fund', s['fund'])), s) for s in res['stages']]
+    metric('stage_calls_total', 'counter', [(k, s['calls']) for (k, s) in stage_labels])
+    metric('stage_seconds_total', 'counter', [(k, s['seconds']) for (k, s) in stage_labels])
+    metric('stage_seconds_max', 'gauge', [(k, s['max']) for (k, s) in stage_labels])
+    metric('events_total', 'counter', [
+        ((('name', c['name']), ('fund', c['fund'])), c['value']) for c in res['counters']])
+    for key in ('requests', 'retries', 'errors', 'bytes', 'seconds'):
+        metric('http_{}_total'.format(key), 'counter', [
+            ((('host', host),), round(stat[key], 6)) for (host, stat) in sorted(res['http'].items())])
+    metric('run_seconds', 'gauge', [((), res['elapsed'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write(json_path=None, prom_path=None):
+    """ 写入 json 报告和 Prometheus 文本，先写临时文件再替换 """
+    res = report()
+    for (path, text) in ((json_path, lambda: json.dumps(res, indent=2)), (prom_path, lambda: prometheus(res))):
+        if path is None:
+            continue
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fw:
+            fw.write(text())
+        os.replace(tmp_path, path)
+    return res
+
+
+def from_env():
+    """ FUNDVALUE_METRICS 为 json 报告路径，FUNDVALUE_METRICS_PROM 为 Prometheus 文本路径，设置任一个时启用 """
+    paths = (os.environ.get('FUNDVALUE_METRICS'), os.environ.get('FUNDVALUE_METRICS_PROM'))
+    if any(paths):
+        enable()
+        reset()
+    return paths
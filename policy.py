@@ -3,28 +3,106 @@
 
 import math
 import datetime
-from danjuan import Danjuan
+
+import numpy as np
+
+from backtest import accumulate, summarize
+from danjuan import get_danjuan
+from decision import REVERT_DAYS, DecisionStream
 from fof import Fof
 from indexs import index_list
+import metrics
+from priceseries import BuySeries, from_ordinal, to_ordinal
+from rolling import BuyWaterIndex
+from store import DayStore
+from tradecal import TradeCalendar
+
+
+class LazyData():
+    """ 第一次读取时调用 loader 方法加载的属性，loader 须给属性赋值，没有赋值时视为 None。
+        值保存在实例的 __dict__ 中，之后的读取不再经过这里，没有额外开销；del 后下次读取重新加载。
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        getattr(obj, self.loader)()
+        return obj.__dict__.setdefault(self.name, None)
 
 
 class Policy(Fof):
     """ 从东方基金获取基金价格，从蛋卷获取指数估值，并加载基金净值和基金购买日志。
+
+        净值、回撤、交易日和 pe/pb 在第一次使用时加载，也可以先用 fetcher.fetch_all 并发获取；
+        购买日志第一次使用时只读取本地记录，补算并保存用 load_buylog。
+        live 为 True 时只读取本地最近 live_days 天的记录，足够计算当天的申购（dt 为 None），
+        用于每日运行；需要补算的回撤或购买日志的窗口超出这个范围时，先改为读取完整记录（见 load_all）。
     """
 
-    def __init__(self, fid):
+    # 当天申购用到的最长窗口：购买日志水位线 6 年，回撤水位线 2160 天，再留出 30 天
+    live_days = 365*6 + 30
+
+    price_list = LazyData('load_fundprice')
+    # 基金组合的虚拟净值和跟踪比例随净值一起计算
+    xnjz = LazyData('load_fundprice')
+    ratio = LazyData('load_fundprice')
+    revert_list = LazyData('load_revert')
+    trade_days = LazyData('init_index_pbe')
+    index_pbe = LazyData('init_index_pbe')
+    buylog = LazyData('init_buylog')
+    dj = LazyData('fetch_index_pbe')
+
+    def __init__(self, fid, live=False):
         Fof.__init__(self, fid)
-        self.buylog = []
+        del self.price_list
+        del self.xnjz
+        del self.ratio
+        del self.revert_list
         self.index = index_list[fid]
+        self.buy_water = None
+        if live:
+            self.tail_days = self.live_days
+
+    def load_all(self):
+        """ 改为读取完整记录，由净值和回撤得到的交易日、pe/pb 和回撤在下次使用时重新加载 """
+        if self.tail_days is None:
+            return
+        Fof.load_all(self)
+        for name in ('trade_days', 'index_pbe', 'revert_list'):
+            self.__dict__.pop(name, None)
+
+    def init_buylog(self):
+        """ 只读取本地的购买日志，不补算也不写文件，没有时为空。补算并保存用 load_buylog。 """
+        try:
+            (days, (capital, amount)) = DayStore(self.buylog_path, 2).load(self.since(), migrate=False)
+            self.buylog = BuySeries(days, capital, amount)
+        except Exception:
+            self.buylog = BuySeries()
+        return self.buylog
+
+    def fetch_index_pbe(self, time='all'):
+        """ 只获取指数的pe/pb，不依赖基金净值，可以和净值并发获取 """
+        if self.index['code'] == '':
+            return None
+        self.dj = get_danjuan(self.index['code'], self.index['vq'])
+        return self.dj.init_pbe(time)
 
     def init_index_pbe(self, time='all'):
-        """ 获取pe/pb的通用接口，time可以为1y, 3y """
-        self.trade_days = set(self.price_list.keys())
+        """ 获取pe/pb的通用接口，time可以为1y, 3y。已经获取过则直接使用。 """
+        self.trade_days = TradeCalendar(self.price_list.days)
         if self.index['code'] == '':
             return None
-        self.dj = Danjuan(self.index['code'], self.index['vq'])
-        self.index_pbe = self.dj.init_pbe(time)
-        self.trade_days = set(self.index_pbe.keys()) & self.trade_days
+        if self.dj is None:
+            self.fetch_index_pbe(time)
+        self.index_pbe = self.dj.pbe
+        # pe/pb 只保存交易日，非交易日按前一个交易日取值，交易日限制在 pe/pb 的历史范围内
+        self.trade_days = TradeCalendar(self.trade_days.between(self.index_pbe.days[0], self.index_pbe.days[-1]))
         return self.index_pbe
 
     def get_weight_pe(self, cur_pe, pe30, n=2):
@@ -51,7 +129,7 @@ class Policy(Fof):
         """
         # 非今天申购，且非交易日，则不予购买。
         res = {}
-        if dt is not None and dt not in self.price_list.keys():
+        if dt is not None and dt not in self.price_list:
             res['price'] = (0, 0)
             res['avg_price'] = (0, 0)
             return res
@@ -75,7 +153,6 @@ class Policy(Fof):
             dt 为 None，则使用当天估值。
         """
         res = {}
-        reverts = []
         edt = dt
         if dt is None:
             n = datetime.datetime.now()
@@ -83,19 +160,7 @@ class Policy(Fof):
             res['revert'] = self.get_revert(dt, price)
         else:
             res['revert'] = self.revert_list.get(dt, 0)
-        for i in range(1, 360*6):
-            d = edt - datetime.timedelta(days=i)
-            r = self.revert_list.get(d, 0)
-            if r > 0:
-                reverts.append(r)
-        if res['revert'] > 0:
-            reverts.append(res['revert'])
-            reverts.sort()
-            res['revert_length'] = len(reverts)
-            res['revert_water'] = round((reverts.index(res['revert']) + 1) * 1.0 / len(reverts), 4)
-        else:
-            res['revert_length'] = len(reverts)
-            res['revert_water'] = 0
+        (res['revert_water'], res['revert_length']) = self.get_revert_water(edt, res['revert'], 360*6)
         return res
 
     def fetch_price_info(self, dt, avgdays):
@@ -112,128 +177,102 @@ class Policy(Fof):
         res.update(revert_info)
         if dt is None:
             dt = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
-        price60 = []
-        for i in range(1, avgdays):
-            d = dt - datetime.timedelta(days=i)
-            if d in self.price_list:
-                price60.append(self.price_list.get(d)[1])
-        price60.append(res['price'][1])
-        price60.sort(reverse=True)
-        res['rank'] = (round(1 - (price60.index(res['price'][1]) + 1) * 1.0 / len(price60), 4), len(price60))
-        res['price60'] = price60
+        (lo, hi) = self.price_list.window(dt, avgdays)
+        # 窗口加上当天按净值倒序排列，当天的位置为严格大于当天净值的个数，相同净值排在最前
+        res['higher'] = int((self.price_list.ljjz[lo:hi] > res['price'][1]).sum())
+        length = hi - lo + 1
+        res['rank'] = (round(1 - (res['higher'] + 1) * 1.0 / length, 4), length)
         return res
 
-    def save_buylog(self, newlog):
+    def save_buylog(self, newlog, saved=None):
         """ 保存新购买的日志，用以衡量本次购买的水位线。
+            saved 为文件中已有的日志时，只追加新增或有变化的记录，否则读取文件合并后重写。
         """
-        buylog = {}
-        try:
-            fr = open(self.buylog_path, 'r')
-            for line in fr.readlines():
-                arr = line.strip().split(',')
-                d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                buylog[d] = {}
-                buylog[d]['capital'] = int(arr[2])
-                buylog[d]['amount'] = float(arr[3])
-            fr.close()
-            buylog.update(newlog)
-            with open(self.buylog_path, 'w') as fw:
-                for d in sorted(buylog.keys()):
-                    result = []
-                    result.append(self.fid)
-                    result.append(d.strftime('%Y-%m-%d'))
-                    result.append(str(buylog[d]['capital']))
-                    result.append(str(buylog[d]['amount']))
-                    line = ','.join(result)
-                    fw.write(line)
-                    fw.write('\n')
+        store = DayStore(self.buylog_path, 2)
+        if saved is not None:
+            buylog = saved.update(newlog)
+            with metrics.stage('persist', self.fid):
+                store.append_changes(
+                    (saved.days, [saved.capital, saved.amount]), (buylog.days, [buylog.capital, buylog.amount]))
             return buylog
+        try:
+            (days, (capital, amount)) = store.load()
+            buylog = BuySeries(days, capital, amount).update(newlog)
         except Exception:
             print('First create buylog')
-            with open(self.buylog_path, 'w') as fw:
-                for d in sorted(newlog.keys()):
-                    result = []
-                    result.append(self.fid)
-                    result.append(d.strftime('%Y-%m-%d'))
-                    result.append(str(newlog[d]['capital']))
-                    result.append(str(newlog[d]['amount']))
-                    line = ','.join(result)
-                    fw.write(line)
-                    fw.write('\n')
-            return newlog
+            buylog = BuySeries().update(newlog)
+        with metrics.stage('persist', self.fid):
+            store.write(buylog.days, buylog.capital, buylog.amount)
+        return buylog
 
     def load_buylog(self, buyfunc, avgdays, begin_date, end_date, n, days=365*6, base=100):
         """ 加载 5 年购买的日志，用以衡量本次购买的水位线。
         """
-        buylog = {}
         if end_date is None:
             now = datetime.datetime.now() - datetime.timedelta(days=1)
             end_date = datetime.datetime(now.year, now.month, now.day, 0, 0, 0)
         if begin_date is None:
             begin_date = end_date - datetime.timedelta(days=days)
-        max_dt = datetime.datetime(1970, 1, 1)
         try:
-            fr = open(self.buylog_path, 'r')
-            for line in fr.readlines():
-                arr = line.strip().split(',')
-                d = datetime.datetime.strptime(arr[1], '%Y-%m-%d')
-                max_dt = d if d > max_dt else max_dt
-                buylog[d] = {}
-                buylog[d]['capital'] = int(arr[2])
-                buylog[d]['amount'] = float(arr[3])
-            fr.close()
+            (log_days, (capital, amount)) = DayStore(self.buylog_path, 2).load(self.since())
+            buylog = BuySeries(log_days, capital, amount)
+            max_dt = buylog.last_date() if len(buylog) > 0 else datetime.datetime(1970, 1, 1)
             if end_date <= max_dt:
                 self.buylog = buylog
                 return buylog
             else:
                 print('Need fetch new buylog')
-                newlog = {}
-                for i in range((end_date - max_dt).days + 1):
-                    dt = max_dt + datetime.timedelta(days=i)
-                    res = getattr(self, buyfunc)(dt, avgdays, n, base)
-                    newlog[dt] = {
-                        'capital': res['capital'],
-                        'amount': res['amount']
-                    }
-                buylog = self.save_buylog(newlog)
+                if not self.covers(max_dt, max(REVERT_DAYS, avgdays)):
+                    self.load_all()
+                newlog = self.fetch_buylog(buyfunc, avgdays, max_dt, end_date, n, base)
+                buylog = self.save_buylog(newlog, buylog)
                 self.buylog = buylog
                 return buylog
         except Exception:
             print('First fetch buylog')
-            newlog = {}
-            for i in range((end_date - begin_date).days + 1):
-                dt = begin_date + datetime.timedelta(days=i)
-                if dt not in self.price_list.keys():
-                    newlog[dt] = {'capital': 0, 'amount': 0}
-                else:
-                    res = getattr(self, buyfunc)(dt, avgdays, n, base)
-                    newlog[dt] = {'capital': res['capital'], 'amount': res['amount']}
+            if not self.covers(begin_date, max(REVERT_DAYS, avgdays)):
+                self.load_all()
+            newlog = self.fetch_buylog(buyfunc, avgdays, begin_date, end_date, n, base)
             self.buylog = self.save_buylog(newlog)
             return self.buylog
 
+    def fetch_buylog(self, buyfunc, avgdays, begin_date, end_date, n, base=100):
+        """ 计算 [begin_date, end_date] 每个自然日的购买记录。
+            用 DecisionStream 依次计算基金的交易日，非交易日直接记为 0。
+        """
+        (b, e) = (to_ordinal(begin_date), to_ordinal(end_date))
+        days = np.arange(b, e + 1, dtype=np.int32)
+        capital = np.zeros(len(days))
+        amount = np.zeros(len(days))
+        with metrics.stage('buylog', self.fid):
+            for (dt, res) in DecisionStream(self, buyfunc, avgdays, n, base).iter(b, e):
+                capital[dt.toordinal() - b] = res['capital']
+                amount[dt.toordinal() - b] = res['amount']
+        metrics.count('buylog_days', len(days), self.fid)
+        return BuySeries(days, capital, amount)
+
     def fetch_buylog_water(self, fprice, end_date=None, days=365*6):
         """ 长期购买一段时间，计算 fprice 的水位线，返回购买历史记录长度。
         """
-        buylist = []
         if end_date is None:
             end_date = datetime.datetime.combine(
                 datetime.date.today(), datetime.datetime.min.time()) - datetime.timedelta(days=1)
-        begin_date = end_date - datetime.timedelta(days=days)
-        dt = begin_date
-        for i in range(days + 1):
-            dt = begin_date + datetime.timedelta(days=i)
-            if dt not in self.trade_days or dt not in self.buylog:
-                continue
-            if self.buylog[dt]['capital'] > 0:
-                buylist.append(self.buylog[dt]['capital'])
-        if len(buylist) <= 20:
-            return (0, len(buylist))
-        if fprice == 0:
-            return (0, len(buylist))
-        buylist.append(fprice)
-        sorted_log = sorted(buylist)
-        weight = 1.0 * sorted_log.index(fprice) / len(sorted_log)
-        return (round(weight, 4), len(buylist))
+        return self.load_buy_water(days).water(fprice, end_date)
+
+    def load_buy_water(self, days=365*6):
+        """ 获取购买日志的水位线索引，购买日志或交易日更新后重建 """
+        src = (self.buylog, self.trade_days, days)
+        if self.buy_water is None or any(a is not b for (a, b) in zip(self.buy_water[0], src)):
+            self.buy_water = (src, BuyWaterIndex(self.buylog, self.trade_days.days, days))
+        return self.buy_water[1]
+
+    def get_buy_water_series(self, begin_date, end_date, days=365*6):
+        """ 批量计算 [begin_date, end_date] 内每个交易日的申购金额在之前 days 天购买日志中的水位线，
+            用于评估 buy_longtime 中按水位线加权购买的效果。返回 (天序号数组, 水位线数组, 窗口长度数组)。
+        """
+        trade_days = self.trade_days.between(begin_date, end_date)
+        (water, length) = self.load_buy_water(days).series(self.buylog, trade_days)
+        return (trade_days, water, length)
 
     def buy_1day1(self, dt, avgdays, n, base=100):
         """ 对指定的某一天进行购买，用于测试，默认买100块钱。
@@ -242,12 +281,7 @@ class Policy(Fof):
             dt is None，表示今天购买，否则校验是否为交易日。
         """
         res = self.fetch_price_info(dt, avgdays)
-        cur_price = res['price'][1]
-        if cur_price > res['avg_price'][1]:
-            return res
-        if cur_price > 0:
-            res['capital'] = int(math.ceil((res['avg_price'][1] / cur_price) ** n['price'] * base))
-            res['amount'] = round(res['capital'] / cur_price, 2)
+        (res['capital'], res['amount']) = self.decide_1day1(res['price'][1], res['avg_price'][1], n, base)
         return res
 
     def buy_1day2(self, dt, avgdays, n, base=100):
@@ -259,13 +293,8 @@ class Policy(Fof):
             dt is None，表示今天购买，否则校验是否为交易日。
         """
         res = self.fetch_price_info(dt, avgdays)
-        (cur_price, price60) = (res['price'][1], res['price60'])
-        weight = ((price60.index(cur_price) + 1) * 1.0 / len(price60)) / 0.5
-        if int(weight) < 1:
-            weight = 0
-        if cur_price > 0:
-            res['capital'] = int(math.ceil(base * weight ** 2))
-            res['amount'] = round(res['capital'] / cur_price, 2)
+        (res['capital'], res['amount']) = self.decide_1day2(
+            res['price'][1], res['higher'], res['rank'][1], n, base)
         return res
 
     def buy_1day3(self, dt, avgdays, n, base=100):
@@ -273,8 +302,26 @@ class Policy(Fof):
             dt is None，表示今天购买，否则校验是否为交易日。
         """
         res = self.fetch_price_info(dt, avgdays)
-        cur_price = res['price'][1]
+        res.update(self.fetch_pe_info(dt))
+        (res['capital'], res['amount']) = self.decide_1day3(
+            res['price'][1], res['avg_price'][1], res['pe'], res['pe30'], n, base)
+        return res
 
+    def buy_1day4(self, dt, avgdays, n, base=100):
+        """ 对指定的某一天进行购买，用于测试，默认买100块钱。
+            主要考虑净值回撤的排位，未考虑价格。
+            n_price 为幂。本策略中无用。
+            n_pe 为幂。本策略中无用。
+            dt is None，表示今天购买，否则校验是否为交易日。
+        """
+        res = self.fetch_price_info(dt, avgdays)
+        (res['capital'], res['amount']) = self.decide_1day4(
+            res['price'][1], res['revert'], res['revert_water'], n, base)
+        return res
+
+    def fetch_pe_info(self, dt):
+        """ 获取指数前一天的 pe 及其水位线 """
+        res = {}
         if dt is None:
             dt = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
         # 计算 pe 权重，由于 pe 无法预估，因此采用前一天的 pe 计算
@@ -284,82 +331,78 @@ class Policy(Fof):
         res['pe50'] = self.dj.get_pbe_nwater(dt, 50, 365*5)
         res['pe70'] = self.dj.get_pbe_nwater(dt, 70, 365*5)
         res['pe90'] = self.dj.get_pbe_nwater(dt, 90, 365*5)
+        o = to_ordinal(dt)
         for i in range(30):
-            res['pe'] = self.index_pbe.get(dt - datetime.timedelta(days=i), -1)
+            res['pe'] = self.dj.get_pbe(o - i, -1)
             if res['pe'] > 0:
                 break
-        weight_pe = self.get_weight_pe(res['pe'], res['pe30'], n['pe'])
+        return res
+
+    # 以下为各策略由当天指标计算 (申购金额, 申购份额) 的规则，逐日计算和 DecisionStream 共用
+
+    def decide_1day1(self, cur_price, avg_price, n, base=100):
+        if cur_price > avg_price:
+            return (0, 0)
+        if cur_price > 0:
+            capital = int(math.ceil((avg_price / cur_price) ** n['price'] * base))
+            return (capital, round(capital / cur_price, 2))
+        return (0, 0)
+
+    def decide_1day2(self, cur_price, higher, length, n, base=100):
+        """ higher 为窗口内累计净值高于当前的个数，length 为窗口长度（含当天） """
+        weight = ((higher + 1) * 1.0 / length) / 0.5
+        if int(weight) < 1:
+            weight = 0
+        if cur_price > 0:
+            capital = int(math.ceil(base * weight ** 2))
+            return (capital, round(capital / cur_price, 2))
+        return (0, 0)
+
+    def decide_1day3(self, cur_price, avg_price, pe, pe30, n, base=100):
+        weight_pe = self.get_weight_pe(pe, pe30, n['pe'])
         # 为更安全，price 标准采用最近1年的均值，时间过长，可能无法申购。也可以考虑采用最近1年，2年均值的最小值。
-        weight_price = self.get_weight_price(cur_price, res['avg_price'][1], n['price'])
+        weight_price = self.get_weight_price(cur_price, avg_price, n['price'])
         weight = weight_pe * weight_price
-
-        res['capital'] = int(math.ceil(base * weight))
+        capital = int(math.ceil(base * weight))
         # 以累计净值计算购买数量，不准确。
         if cur_price > 0:
-            res['amount'] = round(res['capital'] / cur_price, 2)
-        return res
+            return (capital, round(capital / cur_price, 2))
+        return (capital, 0)
 
-    def buy_1day4(self, dt, avgdays, n, base=100):
-        """ 对指定的某一天进行购买，用于测试，默认买100块钱。
-            主要考虑净值回撤的排位，未考虑价格。
-            n_price 为幂。本策略中无用。
-            n_pe 为幂。本策略中无用。
-            dt is None，表示今天购买，否则校验是否为交易日。
-        """
-        res = self.fetch_price_info(dt, avgdays)
-        (revert, water, cur_price) = (res['revert'], res['revert_water'], res['price'][1])
+    def decide_1day4(self, cur_price, revert, water, n, base=100):
         if revert == 0:
-            res['capital'] = 0
-            res['amount'] = 0
+            return (0, 0)
+        if int(water * 100) < 50:
+            weight = 0
         else:
-            if int(res['revert_water'] * 100) < 50:
-                weight = 0
-            else:
-                weight = (res['revert_water'] + 1) ** 6 / 10
-            if cur_price > 0:
-                res['capital'] = int(math.ceil(base * weight))
-                res['amount'] = round(res['capital'] / cur_price, 2)
-        return res
+            weight = (water + 1) ** 6 / 10
+        if cur_price > 0:
+            capital = int(math.ceil(base * weight))
+            return (capital, round(capital / cur_price, 2))
+        return (0, 0)
 
     def buy_longtime(self, buyfunc, avgdays, begin_date, end_date, n, base=100):
         """ 长期购买一段时间，用于测试。默认买100块钱。以最后一天累计净值为基准计算盈利。
         """
         buylog = self.load_buylog(buyfunc, avgdays, begin_date, end_date, n, 365*5, base)
-        b_capital = 0
-        b_amount = 0
-        # 获取最高盈利点
-        maxg = [0, begin_date]
-        for i in range((end_date - begin_date).days + 1):
-            dt = begin_date + datetime.timedelta(days=i)
-            if dt not in self.trade_days:
-                continue
-            # 按购买金额的水位线加权购买，效果略有提升。
-            # 可参考水位线进行一次性投入，不宜作为长期购买指标。
-            # buylist = self.get_buylog(dt)
-            # buylist.append(buylog[dt]['capital'])
-            # buyw = int(self.get_buylog_water(buylist)[0] * 100)
-            # if buyw <= 40:
-            #     weight = 0
-            # elif 40 < buyw and buyw < 70:
-            #     weight = 2
-            # elif buyw >= 70:
-            #     weight = 4
-            weight = 1
-            b_capital = b_capital + buylog[dt]['capital'] * weight
-            b_amount = b_amount + buylog[dt]['amount'] * weight
-            fprice = float(self.price_list[dt][1])
-            if b_capital > 0:
-                g = round((fprice * b_amount - b_capital) / b_capital * 100, 2)
-                if g > maxg[0]:
-                    maxg[0] = g
-                    maxg[1] = dt.strftime('%Y-%m-%d')
-        if b_capital == 0:
-            win = 0
-        else:
-            win = (b_amount * fprice - b_capital) * 100 / b_capital
-        win = str(round(win, 2)) + '%'
-        avg_price = 0 if b_amount == 0 else (b_capital / b_amount)
-        return (round(b_capital, 2), round(b_amount, 2), maxg, win, round(avg_price, 4))
+        days = self.trade_days.between(begin_date, end_date)
+        idx = buylog.find_all(days)
+        if (idx < 0).any():
+            raise KeyError(from_ordinal(days[idx < 0][0]))
+        # 按购买金额的水位线加权购买，效果略有提升。
+        # 可参考水位线进行一次性投入，不宜作为长期购买指标。每天的水位线可用 get_buy_water_series 批量计算。
+        # buylist = self.get_buylog(dt)
+        # buylist.append(buylog[dt]['capital'])
+        # buyw = int(self.get_buylog_water(buylist)[0] * 100)
+        # if buyw <= 40:
+        #     weight = 0
+        # elif 40 < buyw and buyw < 70:
+        #     weight = 2
+        # elif buyw >= 70:
+        #     weight = 4
+        price = self.price_list.ljjz[self.price_list.find_all(days)]
+        curve = accumulate(buylog.capital[idx], buylog.amount[idx], price)
+        return summarize(days, curve, price, begin_date)
 
 
 if __name__ == '__main__':
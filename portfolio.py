@@ -0,0 +1,138 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+
+import numpy as np
+
+from backtest import Backtest, accumulate, py_round, summarize
+from priceseries import from_ordinal, to_ordinal
+
+# base 随投资总额分档调整，缓解定投钝化，见 runa.py 邮件正文
+# (投资总额上限, base)，超过最后一档仍按最后一档
+base_tiers = (
+    (10000, 100),
+    (20000, 200),
+    (40000, 300),
+    (60000, 400),
+    (90000, 500),
+    (120000, 600),
+    (160000, 700),
+    (200000, 800),
+)
+
+
+def tier_base(total, tiers=base_tiers):
+    """ 返回投资总额 total 对应的 (base, 本档上限)，最后一档的上限为无穷大 """
+    for (i, (limit, base)) in enumerate(tiers):
+        if total < limit:
+            return (base, limit if i < len(tiers) - 1 else np.inf)
+    return (tiers[-1][1], np.inf)
+
+
+def tiered_bases(weights, tiers=base_tiers, initial=0):
+    """ 按之前的投资总额计算每天的 base，weights 为 天数 × 基金数 的申购倍数矩阵。
+
+        每天的申购金额为 ceil(base * 倍数)，base 由当天之前所有基金的累计投入决定。
+        base 只会逐档上升，每档内对所有基金一次算出累计投入，找到越过上限的那天再换下一档，
+        循环次数不超过档数。
+    """
+    bases = np.zeros(len(weights))
+    (i, total) = (0, initial)
+    while i < len(weights):
+        (base, limit) = tier_base(total, tiers)
+        cum = total + np.cumsum(np.ceil(base * weights[i:]).sum(axis=1))
+        # 当天投入后越过上限，下一天开始换档
+        k = int(np.searchsorted(cum, limit, side='left'))
+        j = min(i + k + 1, len(weights))
+        bases[i:j] = base
+        total = cum[j - i - 1]
+        i = j
+    return bases
+
+
+class Portfolio():
+    """ 多只基金共用一个 base 的组合回测，与 runa.py 每天对所有基金申购的方式一致。
+
+        各基金按各自的 buyfunc 和参数由 Backtest 算出申购倍数，按所有基金交易日的并集对齐为矩阵，
+        base 按之前所有基金的累计投入分档（base_tiers），再对整个矩阵计算申购金额、份额、市值和盈利。
+        基金没有净值的日期不申购，市值按之前最近的净值计算。
+
+    Attributes:
+        policies: 已加载净值、回撤和 pe/pb 的 Policy 列表（见 fetcher.fetch_all）
+        params: {fid: 参数}，格式与 indexs.index_list 的 params 相同，未指定的使用 index_list 的参数
+        tiers: base 分档
+        initial: 回测开始前已有的投资总额
+    """
+
+    def __init__(self, policies, params=None, tiers=base_tiers, initial=0):
+        self.policies = list(policies)
+        self.params = dict((p.fid, p.index['params']) for p in self.policies)
+        self.params.update(params or {})
+        self.tiers = tiers
+        self.initial = initial
+
+    def matrix(self, begin_date, end_date):
+        """ 返回 (交易日并集, 申购倍数矩阵, 当天净值矩阵, 估值净值矩阵)，没有净值的日期当天净值为 0 """
+        trade_days = [p.trade_days.between(begin_date, end_date) for p in self.policies]
+        days = np.unique(np.concatenate(trade_days)) if trade_days else np.zeros(0, dtype=np.int32)
+        shape = (len(days), len(self.policies))
+        (weights, price, value_price) = (np.zeros(shape), np.zeros(shape), np.zeros(shape))
+        for (j, (p, fdays)) in enumerate(zip(self.policies, trade_days)):
+            params = self.params[p.fid]
+            bt = Backtest(p, params['avgdays'], params['n'])
+            feats = bt.features(fdays, params['buyfunc'])
+            rows = np.searchsorted(days, fdays)
+            weights[rows, j] = bt.weights(params['buyfunc'], feats)
+            price[rows, j] = feats['price']
+            # 向前填充，基金第一次有净值之前为 0
+            last = np.searchsorted(fdays, days, side='right') - 1
+            value_price[:, j] = np.where(last >= 0, feats['price'][np.maximum(last, 0)], 0)
+        return (days, weights, price, value_price)
+
+    def run(self, begin_date, end_date):
+        """ 回测 [begin_date, end_date]，返回每天的矩阵、每只基金和整个组合的汇总结果 """
+        (days, weights, price, value_price) = self.matrix(begin_date, end_date)
+        bases = tiered_bases(weights, self.tiers, self.initial)
+        capital = np.ceil(bases[:, None] * weights)
+        amount = np.zeros(capital.shape)
+        buy = capital > 0
+        amount[buy] = py_round(capital[buy] / price[buy], 2)
+        curve = accumulate(capital, amount, value_price)
+        curve.update({'days': days, 'base': bases, 'buy_capital': capital, 'buy_amount': amount})
+        funds = {}
+        for (j, p) in enumerate(self.policies):
+            column = dict((key, curve[key][:, j]) for key in ('capital', 'amount', 'gain'))
+            funds[p.fid] = summarize(days, column, value_price[:, j], begin_date)
+        curve['funds'] = funds
+        curve['total'] = self.total(days, curve, begin_date)
+        return curve
+
+    def total(self, days, curve, begin_date):
+        """ 整个组合的汇总：(累计投入, 市值, [最高盈利, 日期], 盈利, 最后一天的 base) """
+        capital = curve['capital'].sum(axis=1)
+        value = curve['value'].sum(axis=1)
+        maxg = [0, begin_date]
+        if len(days) == 0:
+            return (0, 0, maxg, '0%', tier_base(self.initial, self.tiers)[0])
+        gain = np.zeros(len(days))
+        invested = capital > 0
+        gain[invested] = py_round((value[invested] - capital[invested]) / capital[invested] * 100, 2)
+        k = int(np.argmax(gain))
+        if gain[k] > 0:
+            maxg = [float(gain[k]), from_ordinal(days[k]).strftime('%Y-%m-%d')]
+        win = str(float(gain[-1])) + '%'
+        return (round(float(capital[-1]), 2), round(float(value[-1]), 2), maxg, win, int(curve['base'][-1]))
+
+
+if __name__ == '__main__':
+    from fetcher import fetch_all
+    from indexs import index_list
+    from policy import Policy
+
+    policies = fetch_all([Policy(fid) for fid in index_list])
+    end_date = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
+    begin_date = end_date - datetime.timedelta(days=365*6)
+    curve = Portfolio(policies).run(to_ordinal(begin_date), to_ordinal(end_date))
+    for (fid, summary) in curve['funds'].items():
+        print(fid, index_list[fid]['name'], summary)
+    print('total', curve['total'])
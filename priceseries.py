@@ -0,0 +1,204 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def to_ordinal(dt):
+    """ 将 datetime/date 转为天序号（date.toordinal），整数原样返回 """
+    if isinstance(dt, (int, np.integer)):
+        return int(dt)
+    return dt.toordinal()
+
+
+def from_ordinal(o):
+    """ 将天序号转为当天零点的 datetime """
+    return datetime.datetime.fromordinal(int(o))
+
+
+class DaySeries(Mapping):
+    """ 按日期升序保存的列存储序列，key 为当天零点的 datetime。
+
+        子类用 columns 声明数值列的属性名，构造、from_dict 和 update 按 columns 处理各列，
+        子类只定义字典的值与各列之间的转换（row 和 value_at）。
+
+    Attributes:
+        days: int32 数组，日期的天序号，升序且唯一。
+    """
+
+    # 数值列的属性名，每列为与 days 等长的 float64 数组
+    columns = ()
+
+    def __init__(self, days=(), *cols):
+        self.days = np.asarray(days, dtype=np.int32)
+        for (i, name) in enumerate(self.columns):
+            setattr(self, name, np.asarray(cols[i] if i < len(cols) else (), dtype=np.float64))
+
+    @staticmethod
+    def row(value):
+        """ 把字典的值转为各列的值 """
+        return ()
+
+    @classmethod
+    def from_dict(cls, values):
+        """ 由 {datetime: value} 字典构造，value 的格式与 value_at 的返回值相同 """
+        keys = sorted(values.keys())
+        rows = [cls.row(values[d]) for d in keys]
+        cols = [[r[i] for r in rows] for i in range(len(cls.columns))]
+        return cls([to_ordinal(d) for d in keys], *cols)
+
+    def update(self, other):
+        """ 合并另一个序列或字典，同一天以 other 为准，返回新的序列 """
+        if not isinstance(other, type(self)):
+            other = type(self).from_dict(other)
+        if len(other) == 0:
+            return self
+        days = np.concatenate((other.days, self.days))
+        # unique 返回每个天序号第一次出现的位置，other 在前即以 other 为准
+        (days, idx) = np.unique(days, return_index=True)
+        cols = [np.concatenate((getattr(other, name), getattr(self, name)))[idx] for name in self.columns]
+        return type(self)(days, *cols)
+
+    def find(self, dt):
+        """ 二分查找指定日期的位置，不存在返回 -1 """
+        o = to_ordinal(dt)
+        i = int(self.days.searchsorted(o))
+        if i < len(self.days) and self.days[i] == o:
+            return i
+        return -1
+
+    def find_all(self, days):
+        """ 批量查找天序号数组的位置，不存在的为 -1 """
+        days = np.asarray(days, dtype=np.int32)
+        if len(self.days) == 0:
+            return np.full(len(days), -1, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.days, days), len(self.days) - 1)
+        return np.where(self.days[idx] == days, idx, -1)
+
+    def asof(self, dt):
+        """ 返回日期不晚于 dt 的最后一个位置，dt 早于第一天返回 -1 """
+        return int(self.days.searchsorted(to_ordinal(dt), side='right')) - 1
+
+    def asof_all(self, days):
+        """ 批量 asof，days 为天序号数组 """
+        return np.searchsorted(self.days, np.asarray(days, dtype=np.int32), side='right') - 1
+
+    def span(self, begin, end):
+        """ 返回日期在 [begin, end) 内的位置区间 (lo, hi)，begin/end 可以为天序号 """
+        lo = int(np.searchsorted(self.days, to_ordinal(begin)))
+        hi = int(np.searchsorted(self.days, to_ordinal(end)))
+        return (lo, hi)
+
+    def window(self, end_date, days):
+        """ 返回 end_date 之前 days-1 天内（不含 end_date）的位置区间 (lo, hi)，
+            与 for i in range(1, days) 逐日向前查询的范围一致。
+        """
+        o = to_ordinal(end_date)
+        return self.span(o - days + 1, o)
+
+    def first_date(self):
+        return from_ordinal(self.days[0])
+
+    def last_date(self):
+        return from_ordinal(self.days[-1])
+
+    def to_dict(self):
+        """ 转为 {datetime: value} 字典 """
+        return dict(self.items())
+
+    def __getitem__(self, dt):
+        i = self.find(dt)
+        if i < 0:
+            raise KeyError(dt)
+        return self.value_at(i)
+
+    def __contains__(self, dt):
+        return self.find(dt) >= 0
+
+    def __iter__(self):
+        for o in self.days:
+            yield from_ordinal(o)
+
+    def __len__(self):
+        return len(self.days)
+
+    def __repr__(self):
+        if len(self) == 0:
+            return '{}([])'.format(type(self).__name__)
+        return '{}({} days, {} ~ {})'.format(
+            type(self).__name__, len(self),
+            self.first_date().strftime('%Y-%m-%d'), self.last_date().strftime('%Y-%m-%d'))
+
+
+class PriceSeries(DaySeries):
+    """ 基金净值序列，以列存储代替 {datetime: (nav, ljjz)} 字典。
+
+    可以当作只读字典使用，value 为 (nav, ljjz)。
+
+    Attributes:
+        nav: float64 数组，单位净值。
+        ljjz: float64 数组，累计净值。
+    """
+
+    columns = ('nav', 'ljjz')
+
+    def __init__(self, days=(), nav=(), ljjz=()):
+        DaySeries.__init__(self, days, nav, ljjz)
+
+    @staticmethod
+    def row(value):
+        return (value[0], value[1])
+
+    @classmethod
+    def from_records(cls, records):
+        """ 由 (date, nav, ljjz) 记录构造，记录可以无序，同一天以最后一条为准 """
+        result = {}
+        for (d, nav, ljjz) in records:
+            result[to_ordinal(d)] = (nav, ljjz)
+        return cls.from_dict(result)
+
+    def value_at(self, i):
+        return (float(self.nav[i]), float(self.ljjz[i]))
+
+
+class ValueSeries(DaySeries):
+    """ 单列数值序列，用于保存回撤等按日计算的结果，value 为 float。
+
+    Attributes:
+        values: float64 数组。
+    """
+
+    columns = ('values', )
+
+    def __init__(self, days=(), values=()):
+        DaySeries.__init__(self, days, values)
+
+    @staticmethod
+    def row(value):
+        return (value, )
+
+    def value_at(self, i):
+        return float(self.values[i])
+
+
+class BuySeries(DaySeries):
+    """ 购买日志序列，value 为 {'capital': 申购金额, 'amount': 申购份额}。
+
+    Attributes:
+        capital: float64 数组，申购金额，读取时转为 int。
+        amount: float64 数组，申购份额。
+    """
+
+    columns = ('capital', 'amount')
+
+    def __init__(self, days=(), capital=(), amount=()):
+        DaySeries.__init__(self, days, capital, amount)
+
+    @staticmethod
+    def row(value):
+        return (value['capital'], value['amount'])
+
+    def value_at(self, i):
+        return {'capital': int(self.capital[i]), 'amount': float(self.amount[i])}
@@ -0,0 +1,325 @@
+# -*- coding:utf-8 -*-
+
+""" 录制和回放东方财富、天天基金估值和蛋卷的接口数据，用于离线运行、性能测试和本地调试。
+
+    录制：httpclient.recorder 设置为 Recorder 后，每个成功的响应按接口合并保存到 fixtures 目录：
+        lsjz/<基金代码>.json       历史净值，LSJZList 的记录，按日期合并
+        gz/<基金代码>.json         实时估值，最后一次的结果
+        eva/<pe|pb>.<指数>.json    pe/pb 历史，index_eva_*_growths 的记录，按 ts 合并
+
+    回放：FakeServer 在本地启动 HTTP 服务，按原接口的参数和格式返回 fixtures 中的数据，
+    可以设置每个请求的延迟；install 把 EastFund/Danjuan 的接口地址指向本地服务。
+
+    python replay.py record fixtures 100038 njbqg   # 在临时目录中完整获取基金数据并录制
+    python replay.py serve fixtures --latency 0.05  # 启动本地服务
+    FUNDVALUE_REPLAY=fixtures python runa.py       # 用本地服务在临时目录中运行每日申购，不发送邮件
+    FUNDVALUE_RECORD=fixtures python runa.py       # 正常运行并录制
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpclient
+from danjuan import Danjuan
+from eastfund import EastFund
+from fof import Fof
+
+
+def parse_jsonp(text):
+    return json.loads(re.match(r'[^(]*[(]({.*})[)][^)]*', text, re.S).group(1))
+
+
+def fixture_path(root, kind, name):
+    return os.path.join(root, kind, name + '.json')
+
+
+def load_fixture(root, kind, name, default=None):
+    path = fixture_path(root, kind, name)
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as fr:
+        return json.load(fr)
+
+
+def copy_fof_records(fund_codes, path):
+    """ 基金组合的净值记录只保存在本地，复制到 path """
+    for fid in fund_codes:
+        fof = Fof(fid)
+        if fof.funds != [] and os.path.exists(fof.record_path):
+            shutil.copy(fof.record_path, path)
+
+
+def save_fixture(root, kind, name, data):
+    path = fixture_path(root, kind, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fw:
+        json.dump(data, fw)
+    os.replace(tmp_path, path)
+
+
+class Recorder():
+    """ 作为 httpclient.recorder，把响应合并保存为 fixtures """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def __call__(self, url, res):
+        u = urlparse(url)
+        query = parse_qs(u.query)
+        text = res.content.decode('utf-8')
+        with self.lock:
+            if u.path.endswith('/lsjz'):
+                fid = query['fundCode'][0]
+                rows = parse_jsonp(text)['Data']['LSJZList']
+                self.merge('lsjz', fid, rows, 'FSRQ')
+            elif u.path.startswith('/js/'):
+                fid = os.path.basename(u.path)[:-len('.js')]
+                save_fixture(self.root, 'gz', fid, parse_jsonp(text))
+            elif '/index_eva/' in u.path:
+                (vq, code) = (u.path.split('/')[-2].split('_')[0], u.path.split('/')[-1])
+                rows = json.loads(text)['data']['index_eva_{}_growths'.format(vq)]
+                self.merge('eva', '{}.{}'.format(vq, code), rows, 'ts')
+
+    def merge(self, kind, name, rows, key):
+        """ 与已有记录按 key 合并，新记录覆盖旧记录，按 key 倒序保存 """
+        merged = dict((r[key], r) for r in load_fixture(self.root, kind, name, []))
+        merged.update((r[key], r) for r in rows)
+        save_fixture(self.root, kind, name, [merged[k] for k in sorted(merged, reverse=True)])
+
+
+class FakeServer():
+    """ 用 fixtures 模拟 lsjz、fundgz 和蛋卷 index_eva 接口的本地 HTTP 服务。
+
+        lsjz 按 startDate/endDate 过滤并按 pageIndex/pageSize 分页；蛋卷 day=1y 时只返回 fixtures 最后一年，
+        响应带 ETag，支持 If-None-Match；估值的日期默认改为今天，使录制的估值在任何一天都有效。
+
+    Attributes:
+        root: fixtures 目录
+        latency: 每个请求的延迟（秒）
+        gz_today: 是否把估值日期改为今天
+        port: 监听端口，0 为自动分配
+        workdir: enter_workdir 创建的临时目录
+    """
+
+    def __init__(self, root, latency=0.0, gz_today=True, host='127.0.0.1', port=0):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.gz_today = gz_today
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        (self.host, self.port) = self.httpd.server_address[:2]
+        self.thread = None
+        self.saved_urls = None
+        (self.workdir, self.saved_cwd) = (None, None)
+        self.lock = threading.Lock()
+        # 按路径统计的请求数
+        self.requests = {}
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def url(self, path):
+        return 'http://{}:{}{}'.format(self.host, self.port, path)
+
+    def handle(self, req):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        u = urlparse(req.path)
+        query = parse_qs(u.query)
+        with self.lock:
+            kind = u.path.split('/')[1] if u.path.count('/') > 1 else u.path
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+        try:
+            if u.path.endswith('/lsjz'):
+                (body, ctype) = (self.lsjz(query), 'application/javascript')
+            elif u.path.startswith('/js/'):
+                (body, ctype) = (self.gz(os.path.basename(u.path)[:-len('.js')]), 'application/javascript')
+            elif '/index_eva/' in u.path:
+                vq = u.path.split('/')[-2].split('_')[0]
+                (body, ctype) = (self.eva(vq, u.path.split('/')[-1], query), 'application/json')
+            else:
+                body = None
+        except KeyError:
+            body = None
+        if body is None:
+            req.send_error(404)
+            return
+        data = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        if req.headers.get('If-None-Match') == etag:
+            req.send_response(304)
+            req.send_header('ETag', etag)
+            req.end_headers()
+            return
+        req.send_response(200)
+        req.send_header('Content-Type', ctype + '; charset=utf-8')
+        req.send_header('Content-Length', str(len(data)))
+        req.send_header('ETag', etag)
+        req.end_headers()
+        req.wfile.write(data)
+
+    def lsjz(self, query):
+        rows = load_fixture(self.root, 'lsjz', query['fundCode'][0])
+        if rows is None:
+            return None
+        start = query.get('startDate', [''])[0]
+        end = query.get('endDate', [''])[0]
+        # 日期为 yyyy-mm-dd，可以直接按字符串比较
+        rows = [r for r in rows if (start == '' or r['FSRQ'] >= start) and (end == '' or r['FSRQ'] <= end)]
+        size = int(query.get('pageSize', ['20'])[0])
+        page = int(query.get('pageIndex', ['1'])[0])
+        data = {
+            'Data': {'LSJZList': rows[(page - 1) * size:page * size]},
+            'TotalCount': len(rows),
+            'PageSize': size,
+            'PageIndex': page,
+        }
+        return '{}({})'.format(query.get('callback', ['jQuery'])[0], json.dumps(data))
+
+    def gz(self, fid):
+        gz = load_fixture(self.root, 'gz', fid)
+        if gz is None:
+            return None
+        if self.gz_today:
+            gz['gztime'] = datetime.date.today().strftime('%Y-%m-%d') + gz['gztime'][10:]
+        return 'jsonpgz({});'.format(json.dumps(gz))
+
+    def eva(self, vq, code, query):
+        rows = load_fixture(self.root, 'eva', '{}.{}'.format(vq, code))
+        if rows is None:
+            return None
+        if query.get('day', ['all'])[0] == '1y' and len(rows) > 0:
+            # ts 为毫秒
+            start = rows[0]['ts'] - 365 * 86400 * 1000
+            rows = [r for r in rows if r['ts'] >= start]
+        return json.dumps({'data': {'index_eva_{}_growths'.format(vq): rows}})
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.uninstall()
+        self.leave_workdir()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def enter_workdir(self, fund_codes=()):
+        """ 切换到临时目录运行，复制基金组合的净值记录。
+            回放时保存的净值、回撤、购买日志和 pe/pb 记录都在临时目录中，不影响正常运行，
+            回放结果也不依赖当前目录已有的记录。
+        """
+        if self.workdir is None:
+            self.saved_cwd = os.getcwd()
+            self.workdir = tempfile.mkdtemp(prefix='fundreplay')
+            copy_fof_records(fund_codes, self.workdir)
+        os.chdir(self.workdir)
+
+    def leave_workdir(self):
+        """ 回到原目录并删除临时目录 """
+        if self.workdir is not None:
+            os.chdir(self.saved_cwd)
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            (self.workdir, self.saved_cwd) = (None, None)
+
+    def install(self):
+        """ 把 EastFund 和 Danjuan 的接口地址指向本地服务 """
+        if self.saved_urls is None:
+            self.saved_urls = (EastFund.lsjz_url, EastFund.gz_url, Danjuan.eva_url)
+        EastFund.lsjz_url = self.url('/f10/lsjz')
+        EastFund.gz_url = self.url('/js/{}.js')
+        Danjuan.eva_url = self.url('/djapi/index_eva/{}_history/{}?day={}')
+
+    def uninstall(self):
+        if self.saved_urls is not None:
+            (EastFund.lsjz_url, EastFund.gz_url, Danjuan.eva_url) = self.saved_urls
+            self.saved_urls = None
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def from_env(fund_codes=()):
+    """ 按环境变量进入回放或录制模式：
+        FUNDVALUE_REPLAY 为 fixtures 目录时启动本地服务，并切换到复制了 fund_codes 中基金组合净值记录的临时目录，
+        FUNDVALUE_LATENCY 为每个请求的延迟（秒）；FUNDVALUE_RECORD 为 fixtures 目录时录制所有响应。
+        返回回放时的 FakeServer，stop 时回到原目录，否则返回 None。
+    """
+    if os.environ.get('FUNDVALUE_REPLAY'):
+        latency = float(os.environ.get('FUNDVALUE_LATENCY', '0'))
+        server = FakeServer(os.environ['FUNDVALUE_REPLAY'], latency).start()
+        server.install()
+        server.enter_workdir(fund_codes)
+        return server
+    if os.environ.get('FUNDVALUE_RECORD'):
+        httpclient.recorder = Recorder(os.environ['FUNDVALUE_RECORD'])
+    return None
+
+
+def record(root, fund_codes):
+    """ 在临时目录中从头获取基金的净值、估值和 pe/pb，完整录制到 root。
+        基金组合的净值记录只保存在本地，复制到临时目录使用。
+    """
+    from fetcher import fetch_all
+    from policy import Policy
+
+    root = os.path.abspath(root)
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix='fundrecord')
+    httpclient.recorder = Recorder(root)
+    policies = [Policy(fid) for fid in fund_codes]
+    copy_fof_records(fund_codes, tmp)
+    try:
+        os.chdir(tmp)
+        fetch_all(policies)
+    finally:
+        httpclient.recorder = None
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='record and replay fund api responses')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_record = sub.add_parser('record', help='录制基金数据')
+    p_record.add_argument('root')
+    p_record.add_argument('fids', nargs='+')
+    p_serve = sub.add_parser('serve', help='启动本地服务')
+    p_serve.add_argument('root')
+    p_serve.add_argument('--port', type=int, default=8000)
+    p_serve.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.cmd == 'record':
+        record(args.root, args.fids)
+    else:
+        server = FakeServer(args.root, args.latency, port=args.port)
+        print('serving {} on {}'.format(args.root, server.url('')))
+        server.httpd.serve_forever()
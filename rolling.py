@@ -0,0 +1,280 @@
+# -*- coding:utf-8 -*-
+
+import bisect
+from collections import deque
+
+import numpy as np
+
+from priceseries import PriceSeries, ValueSeries, to_ordinal
+
+
+def rolling_revert(prices, begin, end, days=360):
+    """ 一次遍历计算 [begin, end] 内每个自然日的回撤，与逐日调用 EastFund.get_revert 结果一致。
+
+        回撤以前 days-1 天（不含当天）累计净值的最大值为基准，非交易日回撤为 0。
+        最大值用单调队列维护，总复杂度 O(n)。
+        prices 为 PriceSeries，返回 ValueSeries。
+    """
+    (b, e) = (to_ordinal(begin), to_ordinal(end))
+    cal = np.arange(b, e + 1, dtype=np.int32)
+    values = np.zeros(len(cal), dtype=np.float64)
+    dd = prices.days.tolist()
+    px = prices.ljjz.tolist()
+    (first, last) = prices.span(b, e + 1)
+    # 第一天窗口的起点，之前的净值不会进入任何窗口
+    (j, _) = prices.span(b - days + 1, b)
+    window = deque()
+    for i in range(first, last):
+        o = dd[i]
+        while j < i:
+            while window and px[window[-1]] <= px[j]:
+                window.pop()
+            window.append(j)
+            j += 1
+        while window and dd[window[0]] < o - days + 1:
+            window.popleft()
+        if not window or px[i] == 0:
+            continue
+        max_price = px[window[0]]
+        if max_price > px[i]:
+            values[o - b] = round((max_price - px[i]) / max_price * 100, 4)
+    return ValueSeries(cal, values)
+
+
+def rolling_avg_price(prices, begin, end, n=50, day=365):
+    """ 一次遍历计算 [begin, end] 内每个自然日前 day-1 天（不含当天）的净值均值或 n 分位数，
+        与逐日调用 EastFund.get_avg_price 结果一致，窗口内没有净值时为 (0, 0)。
+
+        n 为 50 时返回均值，所有窗口同时从最后一天向前逐个累加，求和顺序与逐日计算相同，
+        结果只取决于窗口本身，与序列的起点无关；否则返回 n 分位数，用滑动的有序窗口维护。
+        prices 为 PriceSeries，返回 PriceSeries。
+    """
+    (b, e) = (to_ordinal(begin), to_ordinal(end))
+    cal = np.arange(b, e + 1, dtype=np.int32)
+    lo = np.searchsorted(prices.days, cal - day + 1)
+    hi = np.searchsorted(prices.days, cal)
+    cnt = hi - lo
+    nav = np.zeros(len(cal), dtype=np.float64)
+    ljjz = np.zeros(len(cal), dtype=np.float64)
+    valid = cnt > 0
+    if n == 50:
+        # 第 k 次累加每个窗口倒数第 k+1 个净值，窗口已经加完的加 0
+        for k in range(int(cnt.max()) if len(cal) > 0 else 0):
+            more = cnt > k
+            idx = np.maximum(hi - 1 - k, 0)
+            nav += np.where(more, prices.nav[idx], 0.0)
+            ljjz += np.where(more, prices.ljjz[idx], 0.0)
+        nav[valid] /= cnt[valid]
+        ljjz[valid] /= cnt[valid]
+        return PriceSeries(cal, nav, ljjz)
+    (dwjz, ljjz_list) = (prices.nav.tolist(), prices.ljjz.tolist())
+    (lo, hi, cnt) = (lo.tolist(), hi.tolist(), cnt.tolist())
+    nav_window = []
+    ljjz_window = []
+    (head, tail) = (lo[0], lo[0]) if len(cal) > 0 else (0, 0)
+    for k in range(len(cal)):
+        while tail < hi[k]:
+            bisect.insort(nav_window, dwjz[tail])
+            bisect.insort(ljjz_window, ljjz_list[tail])
+            tail += 1
+        while head < lo[k]:
+            del nav_window[bisect.bisect_left(nav_window, dwjz[head])]
+            del ljjz_window[bisect.bisect_left(ljjz_window, ljjz_list[head])]
+            head += 1
+        if cnt[k] > 0:
+            index = cnt[k] * n // 100 - 1
+            nav[k] = nav_window[index]
+            ljjz[k] = ljjz_window[index]
+    return PriceSeries(cal, nav, ljjz)
+
+
+def asof_values(series, days, missing=-1):
+    """ 按 as-of 取 days 中每个自然日的值，即不晚于当天的最后一个值，
+        与把非交易日用前一个交易日补齐后的结果一致。早于第一天或晚于最后一天的为 missing。
+    """
+    days = np.asarray(days, dtype=np.int32)
+    values = np.full(len(days), missing, dtype=np.float64)
+    if len(series) == 0:
+        return values
+    idx = series.asof_all(days)
+    valid = (idx >= 0) & (days <= series.days[-1])
+    values[valid] = series.values[idx[valid]]
+    return values
+
+
+def rolling_quantiles(series, begin, end, ns, day, missing=-1):
+    """ 一次遍历计算 [begin, end] 内每个自然日前 day 天（含当天）数值的多个分位数，
+        与 Danjuan.get_pbe_nwater 的取法一致：去掉 missing 后排序，取第 len*n//100 个。
+
+        series 只保存交易日，窗口按自然日计数，非交易日取前一个交易日的值（见 asof_values）。
+        有序窗口用 bisect 维护，每天只插入和删除进出窗口的值，分位数按下标直接读取。
+        窗口为空或下标越界时为 nan。
+        series 为 ValueSeries，返回 {n: ValueSeries}。
+    """
+    (b, e) = (to_ordinal(begin), to_ordinal(end))
+    cal = np.arange(b, e + 1, dtype=np.int32)
+    result = dict((n, np.full(len(cal), np.nan)) for n in ns)
+    # 每天进入和离开窗口的值
+    enter = asof_values(series, cal, missing).tolist()
+    leave = asof_values(series, cal - day, missing).tolist()
+    window = sorted(v for v in asof_values(series, np.arange(b - day + 1, b, dtype=np.int32), missing).tolist()
+                    if v != missing)
+    for k in range(len(cal)):
+        if enter[k] != missing:
+            bisect.insort(window, enter[k])
+        if k > 0 and leave[k] != missing:
+            del window[bisect.bisect_left(window, leave[k])]
+        for n in ns:
+            index = len(window) * n // 100
+            if index < len(window):
+                result[n][k] = window[index]
+    return dict((n, ValueSeries(cal, result[n])) for n in ns)
+
+
+def rolling_revert_water(reverts, begin, end, days=360*6):
+    """ 一次遍历计算 [begin, end] 内每个自然日回撤的水位线，与逐日调用 Policy.get_dt_revert 结果一致。
+
+        窗口为前 days-1 天（不含当天）的正回撤，用 RollingRank 维护，每天 O(log n)。
+        当天回撤为 reverts 中的值，没有则为 0，水位线为窗口内严格小于它的个数加一除以窗口长度加一。
+        reverts 为 ValueSeries，返回 (水位线 ValueSeries, 窗口内正回撤个数 ValueSeries, end 当天的窗口 RollingRank)，
+        最后一个窗口用于计算当天实时回撤的水位线。
+    """
+    (b, e) = (to_ordinal(begin), to_ordinal(end))
+    cal = np.arange(b, e + 1, dtype=np.int32)
+    water = np.zeros(len(cal), dtype=np.float64)
+    count = np.zeros(len(cal), dtype=np.float64)
+    dd = reverts.days.tolist()
+    vv = reverts.values.tolist()
+    window = RollingRank(reverts.values[reverts.values > 0])
+    (head, _) = reverts.span(b - days + 1, b)
+    tail = head
+    for k in range(len(cal)):
+        o = b + k
+        while tail < len(dd) and dd[tail] < o:
+            if vv[tail] > 0:
+                window.add(vv[tail])
+            tail += 1
+        while head < tail and dd[head] < o - days + 1:
+            if vv[head] > 0:
+                window.remove(vv[head])
+            head += 1
+        count[k] = len(window)
+        if tail < len(dd) and dd[tail] == o and vv[tail] > 0:
+            water[k] = round((window.count_less(vv[tail]) + 1) * 1.0 / (len(window) + 1), 4)
+    return (ValueSeries(cal, water), ValueSeries(cal, count), window)
+
+
+class RollingRank():
+    """ 滑动窗口的顺序统计，插入、删除和查询排名都是 O(log n)。
+
+        窗口中可能出现的值预先排序去重作为值域，用树状数组记录每个值在窗口中的个数。
+        查询的值可以不在值域中。相同的值按严格大于或严格小于计数，与 list.index 在有序列表中取第一个的结果一致，
+        排名与值进入窗口的先后无关。
+
+    Attributes:
+        keys: 升序的值域
+        tree: 树状数组，tree[i] 为 keys 中一段区间的计数之和
+        size: 窗口中值的个数
+    """
+
+    def __init__(self, values=()):
+        self.keys = np.unique(np.asarray(values, dtype=np.float64)).tolist()
+        self.tree = [0] * (len(self.keys) + 1)
+        self.size = 0
+
+    def add(self, value, delta=1):
+        """ 值进入窗口，value 必须在值域中 """
+        i = bisect.bisect_left(self.keys, value)
+        if i == len(self.keys) or self.keys[i] != value:
+            raise KeyError(value)
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+        self.size += delta
+
+    def remove(self, value):
+        """ 值离开窗口 """
+        self.add(value, -1)
+
+    def prefix(self, k):
+        """ 值域中前 k 个值的计数之和 """
+        total = 0
+        while k > 0:
+            total += self.tree[k]
+            k -= k & -k
+        return total
+
+    def count_less(self, value):
+        """ 窗口中严格小于 value 的个数 """
+        return self.prefix(bisect.bisect_left(self.keys, value))
+
+    def count_greater(self, value):
+        """ 窗口中严格大于 value 的个数 """
+        return self.size - self.prefix(bisect.bisect_right(self.keys, value))
+
+    def __len__(self):
+        return self.size
+
+
+class BuyWaterIndex():
+    """ 购买日志中正申购金额的滑动窗口索引，用于计算申购金额的水位线。
+
+        窗口为 [end-days, end] 内交易日的正申购金额，用 RollingRank 维护，end 向后移动时只插入和删除进出窗口的记录，
+        查询 O(log n)。end 向前移动时从头重建。
+        水位线与 Policy.fetch_buylog_water 一致：窗口记录不超过 20 条或金额为 0 时为 0，
+        否则为窗口内严格小于该金额的个数除以窗口长度加一。
+
+    Attributes:
+        days: 交易日中申购金额为正的天序号
+        capital: 对应的申购金额
+        window: 窗口天数
+    """
+
+    def __init__(self, buylog, trade_days, window=365*6):
+        keep = np.isin(buylog.days, trade_days) & (buylog.capital > 0)
+        self.days = buylog.days[keep].tolist()
+        self.capital = buylog.capital[keep].astype(int).tolist()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.rank = RollingRank(self.capital)
+        self.head = 0
+        self.tail = 0
+        self.end = None
+
+    def move(self, end):
+        """ 把窗口移动到 [end-window, end] """
+        end = to_ordinal(end)
+        if self.end is not None and end < self.end:
+            self.reset()
+        if self.end is None:
+            self.head = self.tail = bisect.bisect_left(self.days, end - self.window)
+        self.end = end
+        while self.tail < len(self.days) and self.days[self.tail] <= end:
+            self.rank.add(self.capital[self.tail])
+            self.tail += 1
+        while self.head < self.tail and self.days[self.head] < end - self.window:
+            self.rank.remove(self.capital[self.head])
+            self.head += 1
+
+    def water(self, fprice, end):
+        """ 返回 (fprice 的水位线, 窗口长度) """
+        self.move(end)
+        count = len(self.rank)
+        if count <= 20 or fprice == 0:
+            return (0, count)
+        return (round(1.0 * self.rank.count_less(fprice) / (count + 1), 4), count + 1)
+
+    def series(self, buylog, days):
+        """ 批量计算 days 中每天申购金额相对之前窗口（截至前一天）的水位线，与每天调用 runa 中的
+            fetch_buylog_water(当天金额, 前一天) 一致。返回 (水位线数组, 窗口长度数组)。
+        """
+        water = np.zeros(len(days))
+        length = np.zeros(len(days), dtype=np.int64)
+        idx = buylog.find_all(days)
+        capital = np.where(idx >= 0, buylog.capital[idx], 0).astype(int).tolist()
+        for (k, o) in enumerate(np.asarray(days).tolist()):
+            (water[k], length[k]) = self.water(capital[k], o - 1)
+        return (water, length)
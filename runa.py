@@ -10,11 +10,16 @@ import datetime
 import os
 
 from policy import Policy
+from decision import DecisionStream
+from fetcher import fetch_all
 from indexs import index_list
-from mailconfig import smtphost, userfrom, userpassword, userto
+import metrics
+import replay
 
 
 def sendmail(receiver, subject, html, att=None, att_name=None):
+    # 邮件配置只在发送时读取，回放时不需要 mailconfig.py
+    from mailconfig import smtphost, userfrom, userpassword
     if att is None:
         msg = MIMEMultipart('alternative')
     else:
@@ -124,21 +129,26 @@ content = u'''
 <br />
 '''
 
-for index_code in (
-        '100038', '001594', '001548', '530015', '003986', '000948',
-        '003765', '090010', '004069', '000248', '001631', '161725',
-        '001550', '162412', '000215', 'njbqg', 'wwxf'):
-    p = Policy(index_code)
-    p.load_fundprice()
-    p.load_revert()
-    p.init_index_pbe()
+fund_codes = (
+    '100038', '001594', '001548', '530015', '003986', '000948',
+    '003765', '090010', '004069', '000248', '001631', '161725',
+    '001550', '162412', '000215', 'njbqg', 'wwxf')
+# 设置了 FUNDVALUE_REPLAY 时使用本地回放服务，在临时目录中运行，不写申购记录也不发送邮件
+server = replay.from_env(fund_codes)
+# 设置了 FUNDVALUE_METRICS/FUNDVALUE_METRICS_PROM 时记录各阶段耗时，结束时写入报告
+metrics_paths = metrics.from_env()
+# 只计算当天的申购，只读取最近几年的本地记录
+policies = fetch_all([Policy(index_code, live=True) for index_code in fund_codes])
+
+for p in policies:
+    index_code = p.fid
     params = p.index['params']
-    today = getattr(p, params['buyfunc'])(None, params['avgdays'], params['n'], 100)
+    today = DecisionStream(p, params['buyfunc'], params['avgdays'], params['n'], 100).live()
     today['name'] = index_list[index_code]['name']
     today['fid'] = index_code
     p.load_buylog(params['buyfunc'], params['avgdays'], None, None, params['n'])
     today['buy_water'] = p.fetch_buylog_water(today['capital'], None, days=365*6)
-    if today['capital'] > 0:
+    if today['capital'] > 0 and server is None:
         cmd = 'echo {},{},{} >>~/buy_fund_log.csv'.format(
             datetime.datetime.now().strftime('%Y-%m-%d'), index_code, today['capital'])
         os.system(cmd)
@@ -157,4 +167,13 @@ else:
     subject = ''.join(slist)
 
 subject = subject1 + subject
-sendmail(userto, subject, content)
+if server is None:
+    from mailconfig import userto
+    with metrics.stage('mail'):
+        sendmail(userto, subject, content)
+else:
+    print(subject)
+    print(content)
+    server.stop()
+if metrics.enabled:
+    metrics.write(*metrics_paths)
@@ -0,0 +1,200 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import os
+
+import numpy as np
+
+# 文件头：4 字节标识，2 字节版本，2 字节列数，4 字节已提交行数，4 字节有序行数
+MAGIC = b'FVDS'
+VERSION = 2
+HEADER_SIZE = 16
+# 追加的乱序/重复行超过该数量时自动整理
+COMPACT_ROWS = 256
+
+
+def row_dtype(ncols):
+    """ 每行为 int32 天序号加 ncols 个 float64，按定长紧凑排列 """
+    return np.dtype([('day', '<i4')] + [('c{}'.format(i), '<f8') for i in range(ncols)])
+
+
+def read_csv(path, ncols):
+    """ 读取旧的 csv 记录：基金代码,日期,数值...
+
+        日期直接按位置解析为天序号，不使用 strptime。数值列少于 ncols 时用第一列补齐，
+        如基金组合的记录只有单位净值。同一天有多行时以最后一行为准，返回按日期升序的结果。
+    """
+    days = []
+    rows = []
+    with open(path, 'r') as fr:
+        for line in fr:
+            arr = line.strip().split(',')
+            if len(arr) < 3:
+                continue
+            s = arr[1]
+            days.append(datetime.date(int(s[0:4]), int(s[5:7]), int(s[8:10])).toordinal())
+            values = [float(v) for v in arr[2:2 + ncols]]
+            rows.append(values + [values[0]] * (ncols - len(values)))
+    days = np.asarray(days, dtype=np.int32)[::-1]
+    cols = np.asarray(rows, dtype=np.float64).reshape(-1, ncols)[::-1]
+    (days, idx) = np.unique(days, return_index=True)
+    return (days, [cols[idx, i].copy() for i in range(ncols)])
+
+
+class DayStore():
+    """ 按日保存数值的二进制文件，用于替代 record/revert/buylog 的 csv 文件。
+
+        文件为 16 字节文件头加定长行，每行为天序号和 ncols 个 float64。
+        前 sorted 行按日期升序且唯一；之后的行是追加的更新日志，读取时同一天以最后写入的为准，
+        日志超过 COMPACT_ROWS 行时重写为有序文件。
+        追加时先写入数据行并落盘，再更新文件头的已提交行数，中途中断只会丢弃未提交的尾部。
+        读取时用内存映射取出各列。
+        二进制文件为 csv 路径加 .bin，只在二进制文件不存在时由 csv 转换，之后不再读取 csv，
+        手工维护的 csv（基金组合的净值记录）用 merge_csv 合并。
+
+    Attributes:
+        path: 二进制文件路径
+        csv_path: 对应的 csv 文件路径
+        ncols: 数值列数
+    """
+
+    def __init__(self, csv_path, ncols):
+        self.csv_path = csv_path
+        self.path = csv_path + '.bin'
+        self.ncols = ncols
+        self.dtype = row_dtype(ncols)
+
+    def header(self, count, sorted_count):
+        return MAGIC + np.array([VERSION, self.ncols], dtype='<u2').tobytes() + \
+            np.array([count, sorted_count], dtype='<u4').tobytes()
+
+    def read_header(self, fr):
+        """ 返回 (已提交行数, 有序行数) """
+        header = fr.read(HEADER_SIZE)
+        if header[:4] != MAGIC:
+            raise IOError('{} is not a day store'.format(self.path))
+        (version, ncols) = np.frombuffer(header[4:8], dtype='<u2').tolist()
+        if ncols != self.ncols:
+            raise IOError('{} has {} columns, expect {}'.format(self.path, ncols, self.ncols))
+        if version == 1:
+            # 第一版没有行数，整个文件都是有序的
+            count = (os.path.getsize(self.path) - HEADER_SIZE) // self.dtype.itemsize
+            return (count, count)
+        return tuple(np.frombuffer(header[8:16], dtype='<u4').tolist())
+
+    def need_migrate(self):
+        return os.path.exists(self.csv_path) and not os.path.exists(self.path)
+
+    def merge_csv(self):
+        """ 把 csv 中新增或有变化的记录合并到二进制文件，二进制文件中 csv 没有的记录保留。
+            只在 csv 比二进制文件新时读取，合并后更新二进制文件的修改时间。
+        """
+        if not os.path.exists(self.csv_path) or self.need_migrate():
+            return
+        if os.path.getmtime(self.csv_path) <= os.path.getmtime(self.path):
+            return
+        (days, cols) = read_csv(self.csv_path, self.ncols)
+        self.append_changes(self.load(), (days, cols))
+        os.utime(self.path)
+
+    def load(self, since=None, migrate=True):
+        """ 读取记录，返回按日期升序的 (days, [col, ...])。文件不存在时抛出 IOError。
+            since 为天序号时只读取该天及之后的记录，有序部分二分查找起点，只复制尾部。
+            migrate 为 False 时需要转换的 csv 只读取，不写二进制文件。
+        """
+        if self.need_migrate():
+            (days, cols) = read_csv(self.csv_path, self.ncols)
+            if migrate:
+                self.write(days, *cols)
+            return self.tail(days, cols, since)
+        with open(self.path, 'rb') as fr:
+            (count, sorted_count) = self.read_header(fr)
+        if count == 0:
+            return (np.zeros(0, dtype=np.int32), [np.zeros(0) for i in range(self.ncols)])
+        rows = np.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+        start = 0
+        if since is not None and sorted_count > 0:
+            start = int(np.searchsorted(rows['day'][:sorted_count], since))
+        days = np.array(rows['day'][start:], dtype=np.int32)
+        cols = [np.array(rows['c{}'.format(i)][start:], dtype=np.float64) for i in range(self.ncols)]
+        del rows
+        if sorted_count < count:
+            # 合并更新日志，同一天以最后写入的为准，日志中可能有 since 之前的记录
+            (days, idx) = np.unique(days[::-1], return_index=True)
+            cols = [col[::-1][idx] for col in cols]
+            return self.tail(days, cols, since)
+        return (days, cols)
+
+    def tail(self, days, cols, since):
+        if since is None:
+            return (days, cols)
+        start = int(np.searchsorted(days, since))
+        return (days[start:], [col[start:] for col in cols])
+
+    def pack(self, days, cols):
+        rows = np.zeros(len(days), dtype=self.dtype)
+        rows['day'] = days
+        for (i, col) in enumerate(cols):
+            rows['c{}'.format(i)] = col
+        return rows.tobytes()
+
+    def write(self, days, *cols):
+        """ 重写整个文件，先写临时文件再替换，写到一半中断不会损坏原文件。days 须升序且唯一。 """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fw:
+            fw.write(self.header(len(days), len(days)))
+            fw.write(self.pack(days, cols))
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(tmp_path, self.path)
+
+    def append(self, days, *cols):
+        """ 在已提交的记录之后追加，写入量只与新增行数成正比。
+            days 升序且都晚于已有记录时文件保持有序，否则作为更新日志，读取时覆盖之前同一天的记录。
+        """
+        if not os.path.exists(self.path):
+            return self.write(days, *cols)
+        if len(days) == 0:
+            return
+        with open(self.path, 'r+b') as fw:
+            (count, sorted_count) = self.read_header(fw)
+            in_order = bool(np.all(np.diff(days) > 0))
+            if in_order and count == sorted_count and count > 0:
+                fw.seek(HEADER_SIZE + (count - 1) * self.dtype.itemsize)
+                last_day = int(np.frombuffer(fw.read(4), dtype='<i4')[0])
+                in_order = days[0] > last_day
+            # 覆盖上次未提交的尾部
+            fw.seek(HEADER_SIZE + count * self.dtype.itemsize)
+            fw.write(self.pack(days, cols))
+            fw.truncate()
+            fw.flush()
+            os.fsync(fw.fileno())
+            count += len(days)
+            if in_order and sorted_count == count - len(days):
+                sorted_count = count
+            fw.seek(0)
+            fw.write(self.header(count, sorted_count))
+            fw.flush()
+            os.fsync(fw.fileno())
+        if count - sorted_count > COMPACT_ROWS:
+            self.compact()
+
+    def append_changes(self, saved, current):
+        """ 只追加 current 中新增或数值有变化的记录。
+            saved 和 current 都是按日期升序的 (days, [col, ...])，saved 为文件中已有的记录。
+        """
+        (days, cols) = saved
+        (new_days, new_cols) = current
+        if len(days) == 0:
+            changed = np.ones(len(new_days), dtype=bool)
+        else:
+            idx = np.minimum(np.searchsorted(days, new_days), len(days) - 1)
+            changed = days[idx] != new_days
+            for (col, new_col) in zip(cols, new_cols):
+                changed |= col[idx] != new_col
+        self.append(new_days[changed], *[col[changed] for col in new_cols])
+
+    def compact(self):
+        """ 合并更新日志，重写为有序文件 """
+        (days, cols) = self.load()
+        self.write(days, *cols)
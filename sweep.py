@@ -0,0 +1,217 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import itertools
+import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from backtest import Backtest
+from danjuan import Danjuan
+from policy import Policy
+from priceseries import PriceSeries, ValueSeries
+from tradecal import TradeCalendar
+
+# 默认搜索范围
+buyfuncs = ('buy_1day1', 'buy_1day2', 'buy_1day3', 'buy_1day4')
+n_prices = (1, 2, 3, 4, 5, 6)
+n_pes = (1, 2, 3, 4)
+avgdays_list = (90, 180, 365, 730)
+
+# 各策略实际用到的参数，其余参数取默认值，避免重复回测结果相同的组合
+used_params = {
+    'buy_1day1': ('price', 'avgdays'),
+    'buy_1day2': ('avgdays',),
+    'buy_1day3': ('price', 'pe', 'avgdays'),
+    'buy_1day4': (),
+}
+default_params = {'price': 4, 'pe': 2, 'avgdays': 365}
+
+
+def grid(buyfuncs=buyfuncs, n_prices=n_prices, n_pes=n_pes, avgdays_list=avgdays_list):
+    """ 网格搜索，返回全部参数组合，格式与 indexs.index_list 的 params 相同 """
+    params = []
+    for buyfunc in buyfuncs:
+        used = used_params[buyfunc]
+        ranges = [
+            values if key in used else (default_params[key],)
+            for (key, values) in (('price', n_prices), ('pe', n_pes), ('avgdays', avgdays_list))]
+        for (n_price, n_pe, avgdays) in itertools.product(*ranges):
+            params.append({'buyfunc': buyfunc, 'n': {'price': n_price, 'pe': n_pe}, 'avgdays': avgdays})
+    return params
+
+
+def random_params(count, buyfuncs=buyfuncs, n_prices=n_prices, n_pes=n_pes, avgdays_list=avgdays_list, seed=None):
+    """ 随机搜索，从网格中不重复地抽取 count 组参数 """
+    params = grid(buyfuncs, n_prices, n_pes, avgdays_list)
+    return random.Random(seed).sample(params, min(count, len(params)))
+
+
+class SharedArrays():
+    """ 把一组只读数组放入一块共享内存，子进程按 spec 映射为数组，不需要随每个任务序列化。
+
+    Attributes:
+        shm: SharedMemory
+        spec: (共享内存名称, [(数组名, dtype, 偏移, 长度)])，可以传给子进程
+    """
+
+    def __init__(self, arrays):
+        layout = []
+        offset = 0
+        for (name, arr) in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            layout.append((name, arr.dtype.str, offset, len(arr)))
+            # 按 8 字节对齐
+            offset += (arr.nbytes + 7) // 8 * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 8))
+        for ((name, dtype, offset, length), arr) in zip(layout, arrays.values()):
+            view = np.ndarray(length, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            view[:] = arr
+            del view
+        self.spec = (self.shm.name, layout)
+
+    @staticmethod
+    def attach(spec):
+        """ 在子进程中映射共享内存，返回 (shm, {数组名: 只读数组})，使用期间须保留 shm """
+        (name, layout) = spec
+        shm = shared_memory.SharedMemory(name=name)
+        arrays = {}
+        for (key, dtype, offset, length) in layout:
+            arr = np.ndarray(length, dtype=dtype, buffer=shm.buf, offset=offset)
+            arr.flags.writeable = False
+            arrays[key] = arr
+        return (shm, arrays)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def share_policy(p):
+    """ 把回测用到的净值、回撤、交易日和 pe/pb 放入共享内存 """
+    arrays = {
+        'price_days': p.price_list.days, 'nav': p.price_list.nav, 'ljjz': p.price_list.ljjz,
+        'revert_days': p.revert_list.days, 'revert': p.revert_list.values,
+        'trade_days': p.trade_days.days,
+    }
+    if p.index['code'] != '':
+        arrays['pbe_days'] = p.index_pbe.days
+        arrays['pbe'] = p.index_pbe.values
+    return SharedArrays(arrays)
+
+
+# 子进程中的共享内存 spec 和已恢复的 Policy，同一进程内的任务共用
+_specs = {}
+_policies = {}
+
+
+def init_worker(specs):
+    _specs.update(specs)
+
+
+def attach_policy(fid):
+    """ 由共享内存恢复只用于回测的 Policy，不读写文件也不发送请求 """
+    if fid not in _policies:
+        (shm, arr) = SharedArrays.attach(_specs[fid])
+        p = Policy(fid)
+        p.price_list = PriceSeries(arr['price_days'], arr['nav'], arr['ljjz'])
+        p.revert_list = ValueSeries(arr['revert_days'], arr['revert'])
+        p.trade_days = TradeCalendar(arr['trade_days'])
+        if 'pbe' in arr:
+            p.dj = Danjuan(p.index['code'], p.index['vq'])
+            p.dj.pbe = ValueSeries(arr['pbe_days'], arr['pbe'])
+            p.index_pbe = p.dj.pbe
+        _policies[fid] = (shm, p)
+    return _policies[fid][1]
+
+
+def run_task(task):
+    """ 回测一组参数，返回结果字典 """
+    (fid, params, begin_date, end_date, base) = task
+    p = attach_policy(fid)
+    bt = Backtest(p, params['avgdays'], params['n'], base)
+    curve = bt.run(params['buyfunc'], begin_date, end_date)
+    (capital, amount, maxg, win, avg_price) = curve['summary']
+    res = {
+        'fid': fid,
+        'params': params,
+        'capital': capital,
+        'amount': amount,
+        'return': 0.0,
+        'max_gain': maxg[0],
+        'max_gain_date': maxg[1] if maxg[0] > 0 else None,
+        'avg_cost': avg_price,
+    }
+    if capital > 0:
+        res['return'] = round((curve['value'][-1] - capital) * 100 / capital, 2)
+    return res
+
+
+def rank(results):
+    """ 按收益率、最高盈利从高到低，平均成本从低到高排序 """
+    return sorted(results, key=lambda r: (-r['return'], -r['max_gain'], r['avg_cost']))
+
+
+def best(results, top=3):
+    """ 按基金分组排序，返回 {fid: 前 top 个结果} """
+    groups = {}
+    for r in results:
+        groups.setdefault(r['fid'], []).append(r)
+    return dict((fid, rank(group)[:top]) for (fid, group) in groups.items())
+
+
+class Sweep():
+    """ 在进程池中对一组基金并行回测多组参数。
+
+        policies 须已加载净值、回撤和 pe/pb（见 fetcher.fetch_all），只读数组通过共享内存传给子进程，
+        每个任务只传递基金代码和参数。没有指数的基金跳过 buy_1day3。
+
+    Attributes:
+        policies: {fid: Policy}
+        begin_date, end_date: 回测区间
+        base: 每天的基础申购金额
+        workers: 进程数，None 为 CPU 核数
+    """
+
+    def __init__(self, policies, begin_date, end_date, base=100, workers=None):
+        self.policies = dict((p.fid, p) for p in policies)
+        self.begin_date = begin_date
+        self.end_date = end_date
+        self.base = base
+        self.workers = workers
+
+    def tasks(self, params_list):
+        tasks = []
+        for (fid, p) in self.policies.items():
+            for params in params_list:
+                if params['buyfunc'] == 'buy_1day3' and p.index['code'] == '':
+                    continue
+                tasks.append((fid, params, self.begin_date, self.end_date, self.base))
+        return tasks
+
+    def run(self, params_list, chunksize=16):
+        """ 回测所有基金和参数的组合，返回按 rank 排序的结果 """
+        shared = dict((fid, share_policy(p)) for (fid, p) in self.policies.items())
+        try:
+            specs = dict((fid, s.spec) for (fid, s) in shared.items())
+            with ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(specs,)) as pool:
+                results = list(pool.map(run_task, self.tasks(params_list), chunksize=chunksize))
+        finally:
+            for s in shared.values():
+                s.close()
+        return rank(results)
+
+
+if __name__ == '__main__':
+    from fetcher import fetch_all
+
+    fund_codes = ('100038', '001548', '000215', 'njbqg')
+    policies = fetch_all([Policy(fid) for fid in fund_codes])
+    end_date = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
+    begin_date = end_date - datetime.timedelta(days=365*6)
+    results = Sweep(policies, begin_date, end_date).run(grid())
+    for (fid, top) in best(results).items():
+        for r in top:
+            print(fid, r['params'], r['return'], r['max_gain'], r['avg_cost'])
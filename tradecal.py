@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+
+import numpy as np
+
+from priceseries import to_ordinal
+
+
+class TradeCalendar():
+    """ 交易日历，将交易日的天序号映射为连续的交易日下标，用于只遍历交易日。
+
+        日期参数可以是 datetime/date 或天序号，内部只使用天序号。
+
+    Attributes:
+        days: int32 数组，交易日的天序号，升序且唯一。
+        index: 自然日到交易日下标的查找表，index[o - days[0]] 为下标，非交易日为 -1。
+    """
+
+    def __init__(self, days=()):
+        self.days = np.unique(np.asarray(days, dtype=np.int32))
+        if len(self.days) == 0:
+            self.index = np.zeros(0, dtype=np.int32)
+        else:
+            self.index = np.full(int(self.days[-1] - self.days[0]) + 1, -1, dtype=np.int32)
+            self.index[self.days - self.days[0]] = np.arange(len(self.days), dtype=np.int32)
+
+    def position(self, dt):
+        """ 返回交易日下标，非交易日返回 -1 """
+        if len(self.days) == 0:
+            return -1
+        i = to_ordinal(dt) - int(self.days[0])
+        if 0 <= i < len(self.index):
+            return int(self.index[i])
+        return -1
+
+    def span(self, begin, end):
+        """ 返回 [begin, end] 内交易日的下标区间 (lo, hi) """
+        lo = int(np.searchsorted(self.days, to_ordinal(begin)))
+        hi = int(np.searchsorted(self.days, to_ordinal(end), side='right'))
+        return (lo, hi)
+
+    def between(self, begin, end):
+        """ 返回 [begin, end] 内交易日的天序号数组 """
+        (lo, hi) = self.span(begin, end)
+        return self.days[lo:hi]
+
+    def __contains__(self, dt):
+        return self.position(dt) >= 0
+
+    def __len__(self):
+        return len(self.days)